@@ -0,0 +1,425 @@
+import argparse
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+import numpy as np
+import pandas as pd
+from fetch import Fetcher
+from kg_builder import add_biomarkers, open_kg
+from linkage import link_biomarkers
+from resource_ext import (
+    CANCER_TYPES, ONCOMX_BASE_URL, adj_mult, adj_src, adj_usage, collapse_panels, concat_biomarkers,
+    extract_cbd, extract_oncomx, extract_sources, extract_upbd)
+
+'''
+Benchmarks for the extraction and knowledge graph build pipeline
+Synthetic UPBD, OncoMX and CBD input files are generated at the requested sizes and every stage is timed,
+offline, from the normalization functions to the full harmonize-and-build run, with its throughput and peak
+memory (traced Python allocations, numpy and pandas buffers included)
+Results can be saved as a JSON baseline, later runs flag stages that got slower or use more memory than it
+Usage: python benchmark.py [n_rows ...] [--baseline FILE] [--save] [--tolerance 0.25] [--panel-ratio 0.3]
+       python benchmark.py --legacy [n_rows ...] compares the normalization functions to their original row-wise versions
+'''
+
+MODEL_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bm_model.owl')
+BASELINE_FILE = 'benchmark_baseline.json'
+
+# The row-wise reference takes minutes above this size, so only the current implementation is timed
+LEGACY_MAX_ROWS = 100_000
+
+SOURCE_MIX = [
+    "Tissue", "Fresh Tissue", "Paraffin block", "paraffin block", "Parrafin block", "tissue",
+    "Cell line", "cell line", "urine", "Urine", "blood", "Blood", "saliva", "human stool",
+    "Stool", "feces", "Tissue, Tissue", "blood, Blood", "Tissue, blood", "Plasma",
+]
+
+def legacy_adj_src(df,del_duplicate):
+    '''
+    Original regex-loop and iterrows implementation of resource_ext.adj_src, kept as a reference
+    '''
+    sources = {
+        ("Fresh Tissue","Paraffin block","Paraffin Block","Parrafin block","paraffin block","parrafin block", "tissue"):"Tissue",
+        ("Cell line","cell line"):"Tissue",
+        ("urine"):"Urine",
+        ("blood"):"Blood",
+        ("saliva"):"Saliva",
+        ("human stool","Stool","stool","feces"):"Feces"
+    }
+    source_ids = {
+        "Tissue":"UBERON_0000479",
+        "Urine":"UBERON_0001088",
+        "Blood":"UBERON_0000178",
+        "Saliva":"UBERON_0001836",
+        "Feces":"UBERON_0001988"
+    }
+    for key, value in sources.items():
+        df["Source"] = df["Source"].replace(to_replace = key, value = value,regex=True)
+    if del_duplicate:
+        for index, row in df.iterrows():
+            src = row['Source'].split(", ")
+            unique_src = list(dict.fromkeys(src))
+            df.at[index,'Source'] = '_'.join(unique_src)
+    df["Source ID"] = df["Source"]
+    for key, value in source_ids.items():
+        df["Source ID"] = df["Source ID"].replace(to_replace = key, value = value,regex=True)
+    return df
+
+MULT_MIX = [
+    "23570400", "21685042_ 19556024", "NCT00001_ NCT00002/NCT00003", "Kit A_ Kit B",
+    "prognostic_ predictive", " diagnostic ", "a, b,c", np.nan,
+]
+
+def legacy_adj_mult(val,sep):
+    '''
+    Original per-value implementation of resource_ext.adj_mult, applied row by row with DataFrame.apply
+    '''
+    if val is np.nan:
+        return val
+    else:
+        val_list = [x.strip() for x in str(val).split(sep)]
+        new_val = "|".join(val_list)
+        return new_val
+
+def synthetic_sources(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({"Source": rng.choice(SOURCE_MIX, size=n_rows)})
+
+def synthetic_mult(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    values = np.array(MULT_MIX, dtype=object)
+    return pd.DataFrame({"Value": values[rng.integers(len(MULT_MIX), size=n_rows)]})
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+def bench_adj_src(n_rows):
+    df = synthetic_sources(n_rows)
+    new, t_new = timed(adj_src, df.copy(), True)
+    if n_rows > LEGACY_MAX_ROWS:
+        print("adj_src\t{} rows\tcurrent {:.3f}s".format(n_rows, t_new))
+        return
+    old, t_old = timed(legacy_adj_src, df.copy(), True)
+    same = new[["Source","Source ID"]].astype(str).equals(old[["Source","Source ID"]].astype(str))
+    print("adj_src\t{} rows\tlegacy {:.3f}s\tcurrent {:.3f}s\tspeedup {:.1f}x\tidentical: {}".format(
+        n_rows, t_old, t_new, t_old/t_new, same))
+
+def bench_adj_mult(n_rows):
+    df = synthetic_mult(n_rows)
+    seps = ("_", None, "/", ",")
+    new, t_new = timed(adj_mult, df["Value"], seps)
+    if n_rows > LEGACY_MAX_ROWS:
+        print("adj_mult\t{} rows\tcurrent {:.3f}s".format(n_rows, t_new))
+        return
+    def legacy(df):
+        for sep in seps:
+            df["Value"] = df.apply(lambda x:legacy_adj_mult(x["Value"],sep), axis = 1)
+        return df["Value"]
+    old, t_old = timed(legacy, df.copy())
+    same = new.equals(old.astype(object))
+    print("adj_mult\t{} rows\tlegacy {:.3f}s\tcurrent {:.3f}s\tspeedup {:.1f}x\tidentical: {}".format(
+        n_rows, t_old, t_new, t_old/t_new, same))
+
+############################################################
+#   Synthetic source feeds                                  #
+############################################################
+
+# Values as they occur in the sources, including the synonyms and misspellings the extractors normalize
+UPBD_USAGE_MIX = [
+    "Diagnosis", "Prognosis", "Diagnosis|Prognosis", "Early diagnosis", "Risk factor", "Staging",
+    "Indicator of severity", "Classification", "Treatment", "Prediction of response to treament", np.nan,
+]
+UPBD_DISEASE_PREFIXES = [
+    "http://purl.bioontology.org/ontology/ICD10CM/C", "http://ncicb.nci.nih.gov/xml/owl/EVS/Thesaurus.owl#C",
+    "http://purl.obolibrary.org/obo/HP_00",
+]
+UPBD_ASSAYS = ["ELISA", "Western blot", "Mass spectrometry", "Immunohistochemistry", np.nan]
+ONCOMX_USAGE_MIX = ["diagnostic_", "prognostic_", "predictive", "predisposition", "diagnostic_ prognostic_", "prognostic_ predictive"]
+ONCOMX_SOURCE_MIX = ["Fresh Tissue", "Paraffin block", "blood", "urine", "saliva", "human stool"]
+ONCOMX_ORIGINS = ["somatic mutation", "germline mutation", "gene expression", "protein expression"]
+CBD_USAGE_MIX = ["Diagnosis", "Prognosis", "Prognosis, Treatment", "Diagnosis, Prognosis", "Early diagnosis", "Staging", np.nan]
+CBD_CATEGORIES = ["Protein", "DNA", "RNA", "miRNA", "Other"]
+
+def _pick(rng, values, size):
+    values = np.array(values, dtype=object)
+    return values[rng.integers(len(values), size=size)]
+
+def _genes(rng, size):
+    # A limited gene pool, so the same biomarker is reported several times as in the real sources
+    return np.char.add('G', rng.integers(max(size // 4, 1), size=size).astype(str)).astype(object)
+
+def synthetic_upbd(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    genes = _genes(rng, n_rows)
+    prefixes = _pick(rng, UPBD_DISEASE_PREFIXES, n_rows)
+    return pd.DataFrame({
+        'Protein name': np.char.add('Protein ', genes.astype(str)).astype(object),
+        'Protein ID': np.char.add('P', genes.astype(str)).astype(object),
+        'Biomarker usage': _pick(rng, UPBD_USAGE_MIX, n_rows),
+        'Treatment': np.nan,
+        'Disease': _pick(rng, ["Bladder cancer", "Kidney disease", "Prostate cancer", "Diabetic nephropathy"], n_rows),
+        'Disease ID': [prefix + str(code) for prefix, code in zip(prefixes, rng.integers(100, 400, size=n_rows))],
+        'In a panel': rng.random(n_rows) < 0.2,
+        'Experiment': _pick(rng, UPBD_ASSAYS, n_rows),
+        'Pmid': rng.integers(10_000_000, 33_000_000, size=n_rows),
+    })
+
+def synthetic_oncomx(n_rows, panel_ratio=0.3, seed=0):
+    '''
+    OncoMX rows, a panel_ratio fraction of them belonging to panels of 2 to 5 genes sharing their test
+    '''
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        'gene_symbol': np.char.lower(_genes(rng, n_rows).astype(str)).astype(object),
+        'test_is_a_panel': 'N',
+        'do_name': _pick(rng, ["breast cancer", "lung cancer", "prostate cancer", "ovarian cancer", "melanoma", "colorectal cancer"], n_rows),
+        'doid': _pick(rng, [1612, 1324, 10283, 2394, 1909, 9256], n_rows),
+        'actual_use': _pick(rng, ONCOMX_USAGE_MIX, n_rows),
+        'test_adoption_evidence': 'clinical use',
+        'specimen_type': _pick(rng, ONCOMX_SOURCE_MIX, n_rows),
+        'test_trade_name': np.char.add('Kit ', rng.integers(max(n_rows // 10, 1), size=n_rows).astype(str)).astype(object),
+        'test_manufacturer': _pick(rng, ["Abbott", "Qiagen", "Roche", "Illumina"], n_rows),
+        'pmid': rng.integers(10_000_000, 33_000_000, size=n_rows).astype(str).astype(object),
+        'biomarker_drug': np.nan,
+        'biomarker_description': np.char.add('description ', rng.integers(50, size=n_rows).astype(str)).astype(object),
+        'biomarker_origin': _pick(rng, ONCOMX_ORIGINS, n_rows),
+        'test_trial_id': _pick(rng, ["-", "NCT00001", "NCT00001_ NCT00002/NCT00003"], n_rows),
+    })
+    # Panel members copy the test of the first member of their panel
+    start = 0
+    panel_rows = int(n_rows * panel_ratio)
+    while start < panel_rows - 1:
+        size = min(int(rng.integers(2, 6)), panel_rows - start)
+        members = df.index[start:start+size]
+        df.loc[members, 'test_is_a_panel'] = 'Y'
+        for col in ['pmid', 'do_name', 'doid', 'biomarker_description', 'actual_use', 'biomarker_origin', 'test_trade_name']:
+            df.loc[members, col] = df.at[members[0], col]
+        start += size
+    return df.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+def synthetic_cbd(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'Biomarker': _genes(rng, n_rows),
+        'Categary': _pick(rng, CBD_CATEGORIES, n_rows),
+        'Discription': 'd',
+        'Location': 'Colon',
+        'Source': _pick(rng, SOURCE_MIX, n_rows),
+        'Experiment': _pick(rng, ["IHC", "qPCR", "ELISA, IHC", np.nan], n_rows),
+        'Application': _pick(rng, CBD_USAGE_MIX, n_rows),
+        'PMID': rng.integers(10_000_000, 33_000_000, size=n_rows),
+        'Statictics': 's',
+        'Conclusion': np.nan,
+    })
+
+def write_feeds(directory, n_rows, panel_ratio=0.3, seed=0):
+    '''
+    Writes synthetic UPBD, OncoMX and CBD input files of n_rows rows per source to directory
+    Files are named after the files they stand in for, so directory can be used as a fetch mirror (BM_MIRROR)
+    Returns the path of the UPBD file
+    '''
+    os.makedirs(directory, exist_ok=True)
+    upbd_file = os.path.join(directory, 'upbd.xlsx')
+    synthetic_upbd(n_rows, seed).to_excel(upbd_file, sheet_name='Page 1', index=False)
+    oncomx = synthetic_oncomx(n_rows, panel_ratio, seed)
+    for cancer_type, part in zip(CANCER_TYPES, np.array_split(np.arange(n_rows), len(CANCER_TYPES))):
+        oncomx.iloc[part].to_csv(os.path.join(directory, os.path.basename(ONCOMX_BASE_URL) + cancer_type + '.csv'), index=False)
+    synthetic_cbd(n_rows, seed).to_excel(os.path.join(directory, 'data.xlsx'), index=False)
+    return upbd_file
+
+def synthetic_panels(n_rows, panel_ratio=0.3, seed=0):
+    '''
+    Returns the OncoMX panel members, renamed as they are passed to collapse_panels
+    '''
+    df = synthetic_oncomx(n_rows, panel_ratio, seed)
+    df = df[df['test_is_a_panel'] == 'Y'].rename(columns={
+        'gene_symbol':'Name','do_name':'Disease','actual_use':'Usage','test_trade_name':'Assay/Test','pmid':'Pmid',
+        'biomarker_description':'Description','biomarker_origin':'Molecular type'})
+    df['Molecular ID'] = df['Name'].str.upper()
+    return df
+
+############################################################
+#   Stages                                                  #
+############################################################
+
+def measure(func, memory=True):
+    '''
+    Runs func once timed and, with memory, once more under tracemalloc, hiding what it prints
+    Returns (result, seconds, peak memory in MB or None)
+    '''
+    with redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = func()
+        seconds = time.perf_counter() - start
+        peak = None
+        if memory:
+            tracemalloc.start()
+            try:
+                func()
+                peak = tracemalloc.get_traced_memory()[1] / 2**20
+            finally:
+                tracemalloc.stop()
+    return result, seconds, peak
+
+def extraction_jobs(feeds, work, fetcher):
+    return {
+        'upbd': (extract_upbd, (os.path.join(feeds, 'upbd.xlsx'), os.path.join(work, 'bm_upbd.parquet')), {'disqover':False, 'fetcher':fetcher}),
+        'oncomx': (extract_oncomx, (os.path.join(work, 'bm_oncomx.parquet'),), {'disqover':False, 'fetcher':fetcher}),
+        'cbd': (extract_cbd, (os.path.join(work, 'bm_cbd.parquet'),), {'disqover':False, 'fetcher':fetcher}),
+    }
+
+def merge(extracted):
+    dfs = []
+    for name, df in extracted.items():
+        if df is None:
+            raise RuntimeError("Extracting {} failed".format(name))
+        df = df.copy()
+        df['Id'] = name+'_'+ df['Id'].astype(str)
+        dfs.append(df)
+    return link_biomarkers(concat_biomarkers(dfs))
+
+def build_kg(merged, store_file):
+    if os.path.exists(store_file):
+        os.remove(store_file)
+    world, biomarker = open_kg(store_file, MODEL_FILE)
+    add_biomarkers(biomarker, merged)
+    world.save()
+    world.close()
+
+def full_run(feeds, work):
+    '''
+    Extracts all sources concurrently, merges and links them and builds the knowledge graph, as harmonize.py
+    '''
+    fetcher = Fetcher(cache_dir=os.path.join(work, 'cache'), offline=True, mirror=feeds)
+    merged = merge(extract_sources(extraction_jobs(feeds, work, fetcher)))
+    build_kg(merged, os.path.join(work, 'bm_db.sqlite3'))
+    return merged
+
+def run_stages(n_rows, work, panel_ratio=0.3, memory=True):
+    '''
+    Generates the synthetic feeds in work and runs every stage on them
+    Returns {stage: {'rows', 'seconds', 'rows_per_s', 'peak_mb'}}, rows being the input rows of the stage
+    '''
+    feeds = os.path.join(work, 'feeds')
+    write_feeds(feeds, n_rows, panel_ratio)
+    fetcher = Fetcher(cache_dir=os.path.join(work, 'cache'), offline=True, mirror=feeds)
+    jobs = extraction_jobs(feeds, work, fetcher)
+    sources = synthetic_cbd(n_rows)[['Source']]
+    usages = synthetic_cbd(n_rows)[['Application']].rename(columns={'Application':'Usage'})
+    mult = synthetic_mult(n_rows)['Value']
+    panels = synthetic_panels(n_rows, panel_ratio)
+    extracted = {}
+
+    stages = [
+        ('adj_src', n_rows, lambda: adj_src(sources.copy(), True)),
+        ('adj_usage', n_rows, lambda: adj_usage(usages.copy(), False)),
+        ('adj_mult', n_rows, lambda: adj_mult(mult, ("_", None, "/", ","))),
+        ('collapse_panels', len(panels), lambda: collapse_panels(panels, ['Pmid','Disease','Description','Usage','Molecular type','Assay/Test'])),
+    ]
+    for name, (func, args, kwargs) in jobs.items():
+        stages.append(('extract_'+name, n_rows, lambda func=func, args=args, kwargs=kwargs, name=name:
+            extracted.__setitem__(name, func(*args, **kwargs))))
+    stages += [
+        ('link', lambda: sum(len(df) for df in extracted.values()), lambda: extracted.__setitem__('merged', merge(
+            {name: extracted[name] for name in jobs}))),
+        ('build_kg', lambda: len(extracted['merged']), lambda: build_kg(extracted['merged'], os.path.join(work, 'bm_db.sqlite3'))),
+        ('full', 3 * n_rows, lambda: full_run(feeds, work)),
+    ]
+
+    results = {}
+    for name, rows, func in stages:
+        rows = rows() if callable(rows) else rows
+        _, seconds, peak = measure(func, memory)
+        results[name] = {
+            'rows': rows, 'seconds': round(seconds, 4), 'rows_per_s': round(rows / seconds) if seconds else None,
+            'peak_mb': None if peak is None else round(peak, 2)}
+    return results
+
+############################################################
+#   Baseline                                                #
+############################################################
+
+def compare(results, baseline, tolerance):
+    '''
+    Input: results of run_stages per size, the same for the baseline, and the tolerated relative increase
+    A stage regresses when its time or peak memory grew by more than tolerance
+    (ignoring differences below 50 ms and 1 MB, which are noise)
+    Returns a list of (size, stage, metric, baseline value, new value)
+    '''
+    regressions = []
+    for size, stages in results.items():
+        for stage, metrics in stages.items():
+            base = baseline.get(size, {}).get(stage)
+            if base is None:
+                continue
+            for metric, floor in [('seconds', 0.05), ('peak_mb', 1.0)]:
+                old, new = base.get(metric), metrics.get(metric)
+                if old is not None and new is not None and new > old * (1 + tolerance) and new - old > floor:
+                    regressions.append((size, stage, metric, old, new))
+    return regressions
+
+def report(size, results, baseline):
+    print("\n{} rows per source".format(size))
+    print("stage\t\trows\tseconds\trows/s\tpeak MB\tvs baseline")
+    for stage, metrics in results.items():
+        base = baseline.get(size, {}).get(stage)
+        change = ''
+        if base and base.get('seconds'):
+            change = '{:+.0f}%'.format((metrics['seconds'] / base['seconds'] - 1) * 100)
+        print("{:<16}{}\t{:.3f}\t{}\t{}\t{}".format(
+            stage, metrics['rows'], metrics['seconds'], metrics['rows_per_s'],
+            '-' if metrics['peak_mb'] is None else metrics['peak_mb'], change))
+
+def legacy_main(sizes):
+    for n_rows in sizes or [10_000, 100_000, 1_000_000]:
+        bench_adj_src(n_rows)
+        bench_adj_mult(n_rows)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the extraction and knowledge graph build pipeline on synthetic feeds")
+    parser.add_argument('sizes', nargs='*', type=int, help="rows per source (default: 1000 10000)")
+    parser.add_argument('--baseline', default=BASELINE_FILE, help="JSON baseline to compare to (default: %(default)s)")
+    parser.add_argument('--save', action='store_true', help="save the results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="tolerated relative increase (default: %(default)s)")
+    parser.add_argument('--panel-ratio', type=float, default=0.3, help="fraction of OncoMX rows in panels (default: %(default)s)")
+    parser.add_argument('--no-memory', action='store_true', help="skip the traced run measuring peak memory")
+    parser.add_argument('--legacy', action='store_true', help="compare the normalization functions to their row-wise originals")
+    args = parser.parse_args(argv)
+    if args.legacy:
+        legacy_main(args.sizes)
+        return 0
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    results = {}
+    for n_rows in args.sizes or [1_000, 10_000]:
+        work = tempfile.mkdtemp(prefix='bm_benchmark_')
+        try:
+            results[str(n_rows)] = run_stages(n_rows, work, args.panel_ratio, not args.no_memory)
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+        report(str(n_rows), results[str(n_rows)], baseline)
+
+    regressions = compare(results, baseline, args.tolerance)
+    for size, stage, metric, old, new in regressions:
+        print("REGRESSION\t{} rows\t{}\t{}: {} -> {}".format(size, stage, metric, old, new))
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({
+                'python': sys.version.split()[0], 'pandas': pd.__version__, 'numpy': np.__version__,
+                'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'results': results}, f, indent=1)
+        print("Saved baseline to "+args.baseline)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
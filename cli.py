@@ -0,0 +1,137 @@
+import argparse
+import sys
+from paths import SOURCES, Paths
+
+'''
+Command line of the harmonization pipeline, e.g.
+    python cli.py extract upbd          extracts one source to bm_upbd.parquet
+    python cli.py merge                 merges and links the extracted sources into merged.parquet
+    python cli.py build-kg              builds the knowledge graph store from merged.parquet
+    python cli.py run                   all of the above, as harmonize.py
+    python cli.py query --source Urine --usage DiagnosticBM
+pandas, pyarrow and owlready2 are only imported by the commands using them, so --help and queries start fast
+'''
+
+# Fields of query.Biomarker printed by the query command
+QUERY_FIELDS = ['id', 'name', 'usages', 'diseases', 'sources', 'assays', 'pmids', 'evidence_levels', 'molecular_ids']
+
+def _pipeline(step):
+    '''
+    Wraps a pipeline command so its stages are recorded in the run report and summarized at the end
+    '''
+    def command(args, paths):
+        import warnings
+        from instrument import start_run
+        warnings.filterwarnings('ignore')
+        report = start_run()
+        step(args, paths)
+        report.write(paths.report)
+        print("\n"+report.summary())
+        print("Run report written to "+paths.report)
+    return command
+
+@_pipeline
+def extract(args, paths):
+    from harmonize import extract
+    extract(paths, args.sources or SOURCES, full_rebuild=args.full, disqover=args.disqover)
+
+@_pipeline
+def merge(args, paths):
+    from harmonize import merge
+    merge(paths, disqover=args.disqover)
+
+@_pipeline
+def build_kg(args, paths):
+    from harmonize import build_kg
+    build_kg(paths, full_rebuild=args.full)
+
+def run(args, paths):
+    import warnings
+    from harmonize import run
+    warnings.filterwarnings('ignore')
+    run(paths, full_rebuild=args.full or None, disqover=args.disqover)
+
+def create_model(args, paths):
+    from create_bm_ontology import create_model
+    create_model(args.model or paths.model)
+
+def query(args, paths):
+    from kg_builder import open_kg
+    from query import BiomarkerIndex
+    world, biomarker = open_kg(args.store or paths.store, read_only=True)
+    index = BiomarkerIndex(world, biomarker)
+    if args.sparql or args.sparql_file:
+        text = args.sparql
+        if args.sparql_file:
+            with open(args.sparql_file) as f:
+                text = f.read()
+        for row in index.sparql(text):
+            print('\t'.join('' if value is None else str(value) for value in row))
+    else:
+        print('\t'.join(QUERY_FIELDS))
+        for bm in index.find(disease=args.disease, usage=args.usage, source=args.source, pmid=args.pmid,
+                             evidence_level=args.evidence_level, molecular_id=args.molecular_id):
+            print('\t'.join(value if isinstance(value, str) else '|'.join(value) for value in bm))
+    world.close()
+
+def parser():
+    '''
+    Returns the argparse.ArgumentParser of the command line
+    '''
+    parser = argparse.ArgumentParser(description="Biomarker harmonization pipeline and knowledge graph")
+    parser.add_argument('--data-dir', help="directory of the extracted sources, merged table and manifest (default: this directory)")
+    parser.add_argument('--model-dir', help="directory of bm_model.owl and the knowledge graph (default: BM_MODEL_DIR, else D:/ontoforce/model)")
+    parser.add_argument('--report', help="JSON run report (default: BM_REPORT, else run_report.json in the data directory)")
+    commands = parser.add_subparsers(dest='command', metavar='command', required=True)
+
+    cmd = commands.add_parser('extract', help="extract sources to their Parquet files")
+    cmd.add_argument('sources', nargs='*', metavar='source', help="sources to extract: {} (default: all)".format(', '.join(SOURCES)))
+    cmd.add_argument('--full', action='store_true', help="extract even if the input files did not change")
+    cmd.add_argument('--disqover', action='store_true', help="use the DISQOVER labels and URIs instead of the ontology ones")
+    cmd.add_argument('--upbd-file', help="UPBD dump (default: upbd.xls in the data directory)")
+    cmd.set_defaults(func=extract)
+
+    cmd = commands.add_parser('merge', help="merge and link the extracted sources into merged.parquet")
+    cmd.add_argument('--disqover', action='store_true', help="the sources were extracted with --disqover")
+    cmd.set_defaults(func=merge)
+
+    cmd = commands.add_parser('build-kg', help="build the knowledge graph store from merged.parquet")
+    cmd.add_argument('--full', action='store_true', help="rebuild the whole store instead of the changed biomarkers")
+    cmd.set_defaults(func=build_kg)
+
+    cmd = commands.add_parser('run', help="extract, merge and build the knowledge graph, as harmonize.py")
+    cmd.add_argument('--full', action='store_true', help="extract all sources and rebuild the whole store")
+    cmd.add_argument('--disqover', action='store_true', help="use the DISQOVER labels and URIs instead of the ontology ones")
+    cmd.add_argument('--upbd-file', help="UPBD dump (default: upbd.xls in the data directory)")
+    cmd.set_defaults(func=run)
+
+    cmd = commands.add_parser('create-model', help="create the classes and properties of the ontology model")
+    cmd.add_argument('--model', help="ontology model file (default: bm_model.owl in the model directory)")
+    cmd.set_defaults(func=create_model)
+
+    cmd = commands.add_parser('query', help="find biomarkers in the knowledge graph, printed as tab separated values")
+    cmd.add_argument('--store', help="knowledge graph store (default: bm_db.sqlite3 in the model directory)")
+    cmd.add_argument('--disease', action='append', help="disease IRI or label, can be repeated")
+    cmd.add_argument('--usage', action='append', help="usage class (e.g. DiagnosticBM), can be repeated")
+    cmd.add_argument('--source', action='append', help="source name or label (e.g. Urine), can be repeated")
+    cmd.add_argument('--pmid', action='append', help="PMID, can be repeated")
+    cmd.add_argument('--evidence-level', help="evidence level")
+    cmd.add_argument('--molecular-id', help="part of the molecular ID (e.g. BRCA1)")
+    cmd.add_argument('--sparql', help="SPARQL query to run instead")
+    cmd.add_argument('--sparql-file', help="file with the SPARQL query to run instead")
+    cmd.set_defaults(func=query)
+    return parser
+
+def main(argv=None):
+    cli = parser()
+    args = cli.parse_args(argv)
+    unknown = set(getattr(args, 'sources', None) or ()) - set(SOURCES)
+    if unknown:
+        cli.error("unknown sources: {} (choose from {})".format(', '.join(sorted(unknown)), ', '.join(SOURCES)))
+    paths = Paths(args.data_dir, args.model_dir, getattr(args, 'upbd_file', None))
+    if args.report:
+        paths.report = args.report
+    args.func(args, paths)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+'''
+Columnar intermediate store of the pipeline
+Extracted sources and the merged table are kept as Parquet files, which keep the dtypes (categoricals included)
+and are read memory-mapped and by column, so every consumer only loads the columns it needs
+Human-facing XLSX, CSV and JSON files are optional exports of these tables, turned on with BM_EXPORTS:
+    BM_EXPORTS=1         the formats the pipeline used to write (e.g. csv for UPBD, json and xlsx for OncoMX)
+    BM_EXPORTS=csv,xlsx  the given formats for every table
+'''
+
+EXPORT_FORMATS = ('csv', 'json', 'xlsx')
+
+# Inferred types of object columns that convert to one Parquet type
+_SINGLE_TYPES = ('string', 'integer', 'floating', 'boolean', 'empty', 'bytes', 'decimal', 'date', 'datetime')
+
+def canonical(df):
+    '''
+    Input: a pandas.DataFrame
+    Object columns mixing several value types (e.g. PMIDs as numbers and '|' joined strings) are converted
+    to strings, missing values are kept, so that the column has one type in Parquet
+    Returns the converted DataFrame
+    '''
+    converted = {}
+    for col in df.columns[df.dtypes == object]:
+        if pd.api.types.infer_dtype(df[col], skipna=True) not in _SINGLE_TYPES:
+            converted[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    return df.assign(**converted) if converted else df
+
+def write_table(df, file, schema=None):
+    '''
+    Writes a pandas.DataFrame to a Parquet file (without its index), through a temporary file
+    schema: an optional pyarrow.Schema the columns are cast to
+    '''
+    table = pa.Table.from_pandas(canonical(df), schema=schema, preserve_index=False)
+    tmp = file + '.tmp'
+    pq.write_table(table, tmp)
+    os.replace(tmp, file)
+
+class TableWriter:
+    '''
+    Writes a Parquet file chunk by chunk, one row group per chunk, through a temporary file
+    that replaces file when the writer is closed without error
+    columns: the columns to write, as strings unless their pyarrow type is given in types (e.g. {'Id': pa.int64()})
+    write() returns the chunk as written, e.g. to export it chunk by chunk as well
+    '''
+    def __init__(self, file, columns, types=None):
+        types = types or {}
+        self.file = file
+        self.schema = pa.schema([(col, types.get(col, pa.string())) for col in columns])
+        self._tmp = file + '.tmp'
+        self._writer = pq.ParquetWriter(self._tmp, self.schema)
+
+    def write(self, df):
+        columns = {}
+        for field in self.schema:
+            col = df[field.name]
+            if pa.types.is_string(field.type) and not pd.api.types.is_string_dtype(col):
+                col = col.astype(object).where(col.isna(), col.astype(str))
+            columns[field.name] = col
+        chunk = pd.DataFrame(columns)
+        self._writer.write_table(pa.Table.from_pandas(chunk, schema=self.schema, preserve_index=False))
+        return chunk
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._writer.close()
+        if exc_type is None:
+            os.replace(self._tmp, self.file)
+        else:
+            os.remove(self._tmp)
+
+def read_table(file, columns=None):
+    '''
+    Reads a Parquet file written by write_table, memory-mapped, only loading the given columns (default: all)
+    Returns a pandas.DataFrame
+    '''
+    table = pq.read_table(file, columns=columns, memory_map=True)
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+def export_formats(default):
+    '''
+    Input: the formats a table used to be written in (e.g. ['json', 'xlsx'])
+    Returns the formats to export it in according to BM_EXPORTS
+    '''
+    value = os.environ.get('BM_EXPORTS', '0').lower()
+    if value in ('', '0'):
+        return []
+    if value in ('1', 'all'):
+        return list(default)
+    formats = [fmt.strip() for fmt in value.split(',') if fmt.strip()]
+    unknown = set(formats) - set(EXPORT_FORMATS)
+    if unknown:
+        raise ValueError("Unknown export formats in BM_EXPORTS: {}".format(', '.join(sorted(unknown))))
+    return formats
+
+def export_table(df, file, formats, columns=None):
+    '''
+    Input: a pandas.DataFrame, the Parquet file it is stored in and the formats to export it in
+    Writes the exports next to the Parquet file with the extension of their format,
+    only the given columns (default: all) for csv and xlsx
+    Returns the list of written files
+    '''
+    stem = os.path.splitext(file)[0]
+    written = []
+    for fmt in formats:
+        out = stem + '.' + fmt
+        if fmt == 'csv':
+            df.to_csv(out, columns=columns, index=False)
+        elif fmt == 'xlsx':
+            df.to_excel(out, columns=columns, index=False)
+        elif fmt == 'json':
+            df.to_json(out, orient='records')
+        else:
+            raise ValueError("Unknown export format: "+fmt)
+        written.append(out)
+    return written
@@ -1,91 +1,109 @@
-from owlready2 import *
+import sys
 
-biomarker = get_ontology("file://D:/ontoforce/model/bm_model.owl").load()
+'''
+Creates the classes and properties of the biomarker ontology model in model_file (bm_model.owl)
+Run as `python create_bm_ontology.py [model_file]` or `python cli.py create-model`
+owlready2 is only imported when the model is created
+'''
 
-with biomarker:
+MODEL_FILE = 'D:/ontoforce/model/bm_model.owl'
 
-    print("Creating classes")
-    class Biomarker(Thing):
-        pass
-    class BiomarkerType(Biomarker):
-        pass
-    class BiomarkerUsage(Biomarker):
-        pass
-    class DiagnosticBM(BiomarkerUsage):
-        pass
-    class PrognosticBM(BiomarkerUsage):
-        pass
-    class PredictiveBM(BiomarkerUsage):
-        pass
-    class ResponseBM(BiomarkerUsage):
-        pass
-    class RiskBM(BiomarkerUsage):
-        pass
-    class MolecularBM(BiomarkerType):
-        pass
-    class PhysiologicBM(BiomarkerType):
-        pass
-    class RadiographicBM(BiomarkerType):
-        pass
+def create_model(model_file=MODEL_FILE):
+    '''
+    Input: the path of the ontology model file
+    Adds the biomarker classes and properties to the ontology and saves it to the same file
+    Returns the ontology
+    '''
+    from owlready2 import DataProperty, ObjectProperty, Thing, get_ontology
+    biomarker = get_ontology("file://"+model_file).load()
 
-    class ComplexBM(Thing):
-        pass
-    class Disease(Thing):
-        pass
-    class AnatomicalEntity(Thing):
-        pass
-    class AssayTest(Thing):
-        pass
-    class Treatment(Thing):
-        pass
-    class Publication(Thing):
-        pass
+    with biomarker:
 
-    print("Creating properties")
-    # Properties for biomarker minimal information
-    class indicatorOf(ObjectProperty):
-        domain = [Biomarker]
-        range = [Disease]
-    class hasIndicator(ObjectProperty):
-        domain = [Disease]
-        range = [Biomarker]
-        inverse_property = indicatorOf
-    class hasEvidenceLevel(DataProperty):
-        domain = [Biomarker]
-        range = [str]
-    class hasEvidence(ObjectProperty): 
-        domain = [Biomarker]
-        range = [Publication]
-    class measuredIn(ObjectProperty):
-        domain = [Biomarker]
-        range = [AnatomicalEntity] # Source or Location
-    class measuredBy(ObjectProperty):
-        domain = [Biomarker]
-        range = [AssayTest] # Assay, Experiment, Technology (one or many) 
+        print("Creating classes")
+        class Biomarker(Thing):
+            pass
+        class BiomarkerType(Biomarker):
+            pass
+        class BiomarkerUsage(Biomarker):
+            pass
+        class DiagnosticBM(BiomarkerUsage):
+            pass
+        class PrognosticBM(BiomarkerUsage):
+            pass
+        class PredictiveBM(BiomarkerUsage):
+            pass
+        class ResponseBM(BiomarkerUsage):
+            pass
+        class RiskBM(BiomarkerUsage):
+            pass
+        class MolecularBM(BiomarkerType):
+            pass
+        class PhysiologicBM(BiomarkerType):
+            pass
+        class RadiographicBM(BiomarkerType):
+            pass
 
-    # optional property - additional info
-    class hasDescription(DataProperty):
-        domain = [Biomarker]
-        range = [str]
+        class ComplexBM(Thing):
+            pass
+        class Disease(Thing):
+            pass
+        class AnatomicalEntity(Thing):
+            pass
+        class AssayTest(Thing):
+            pass
+        class Treatment(Thing):
+            pass
+        class Publication(Thing):
+            pass
 
-    # Properties for MolecularBM
-    class hasMolecularType(DataProperty):
-        domain = [MolecularBM]
-        range = [str] # protein,metabolite,nucleic acid - or gene,variation, 
-    class hasMolecularID(DataProperty):
-        domain = [MolecularBM]
-        range = [str] # Uniprot, HGNC, Ensemble, chembl,...
+        print("Creating properties")
+        # Properties for biomarker minimal information
+        class indicatorOf(ObjectProperty):
+            domain = [Biomarker]
+            range = [Disease]
+        class hasIndicator(ObjectProperty):
+            domain = [Disease]
+            range = [Biomarker]
+            inverse_property = indicatorOf
+        class hasEvidenceLevel(DataProperty):
+            domain = [Biomarker]
+            range = [str]
+        class hasEvidence(ObjectProperty): 
+            domain = [Biomarker]
+            range = [Publication]
+        class measuredIn(ObjectProperty):
+            domain = [Biomarker]
+            range = [AnatomicalEntity] # Source or Location
+        class measuredBy(ObjectProperty):
+            domain = [Biomarker]
+            range = [AssayTest] # Assay, Experiment, Technology (one or many) 
+
+        # optional property - additional info
+        class hasDescription(DataProperty):
+            domain = [Biomarker]
+            range = [str]
+
+        # Properties for MolecularBM
+        class hasMolecularType(DataProperty):
+            domain = [MolecularBM]
+            range = [str] # protein,metabolite,nucleic acid - or gene,variation, 
+        class hasMolecularID(DataProperty):
+            domain = [MolecularBM]
+            range = [str] # Uniprot, HGNC, Ensemble, chembl,...
     
-    # Properties for predictiveBM
-    class hasTrearment(ObjectProperty):
-        domain = [PredictiveBM | ResponseBM]
-        range = [Treatment] # name of medicine or other treatment
+        # Properties for predictiveBM
+        class hasTrearment(ObjectProperty):
+            domain = [PredictiveBM | ResponseBM]
+            range = [Treatment] # name of medicine or other treatment
     
-    # Biomarker panel will be linked to single biomarker instances
-    class hasComponent(ObjectProperty):
-        domain = [ComplexBM]
-        range = [Biomarker]
+        # Biomarker panel will be linked to single biomarker instances
+        class hasComponent(ObjectProperty):
+            domain = [ComplexBM]
+            range = [Biomarker]
 
+    biomarker.save(file=model_file)
+    print("Ontology is saved to file")
+    return biomarker
 
-biomarker.save()
-print("Ontology is saved to file")
+if __name__ == "__main__":
+    create_model(*sys.argv[1:2])
@@ -0,0 +1,127 @@
+import csv
+import os
+import re
+import threading
+import numpy as np
+import pandas as pd
+
+'''
+Resolution of disease identifiers to the URIs used in the knowledge graph
+Identifiers are resolved once per distinct value through a memoized table, by prefix rules and an optional
+cross-walk file, and the results are broadcast back to all rows through categorical codes
+'''
+
+DOID_BASE = 'http://purl.obolibrary.org/obo/DOID_'
+BIOONTOLOGY_PREFIX = 'http://purl.bioontology.org/'
+NCI_PREFIX = 'http://ncicb.nci.nih.gov/xml/owl/EVS/Thesaurus.owl'
+DISQOVER_BASE = 'http://ns.ontoforce.com/datasets/'
+
+# Bare Disease Ontology identifiers: '1612', 'DOID:1612' or 'DOID_1612', or '1612.0' when read as a float
+_DOID_PATTERN = re.compile(r'(?:DOID[:_])?(\d+)(?:\.0+)?', re.IGNORECASE)
+
+class DiseaseIdResolver:
+    '''
+    Maps disease identifiers to URIs:
+    - Disease Ontology identifiers become http://purl.obolibrary.org/obo/DOID_ URIs
+    - with disqover, BioPortal and NCI Thesaurus URIs become DISQOVER dataset URIs:
+        http://purl.bioontology.org/ontology/ICD10CM/C67 -> http://ns.ontoforce.com/datasets/icd10/C67
+        http://ncicb.nci.nih.gov/xml/owl/EVS/Thesaurus.owl#C114841 -> http://ns.ontoforce.com/datasets/nci/C114841
+    - other identifiers are kept
+    The cross-walk file (argument or BM_DISEASE_XWALK) is a CSV file with 'id' and 'resolved' columns,
+    its entries take precedence over the rules; save() writes the table back to it with every identifier seen,
+    to review or edit. As the rules differ with disqover, that mode uses its own file, named with a '.disqover'
+    suffix (e.g. xwalk.csv -> xwalk.disqover.csv)
+    '''
+    def __init__(self, disqover=False, crosswalk=None):
+        self.disqover = disqover
+        self.crosswalk = crosswalk_file(crosswalk or os.environ.get('BM_DISEASE_XWALK'), disqover)
+        self.table = {}
+        if self.crosswalk and os.path.exists(self.crosswalk):
+            with open(self.crosswalk, newline='') as f:
+                self.table = {row['id']: row['resolved'] for row in csv.DictReader(f)}
+
+    def resolve(self, value):
+        '''
+        Returns the URI for one disease identifier, missing values are kept
+        '''
+        if pd.isnull(value):
+            return value
+        key = str(value)
+        if key not in self.table:
+            self.table[key] = self._apply_rules(key.strip())
+        return self.table[key]
+
+    def resolve_series(self, series):
+        '''
+        Input: a pandas.Series of disease identifiers
+        Resolves every distinct identifier once
+        Returns a categorical pandas.Series with the same index
+        '''
+        values = series.astype(str).where(series.notna()) if not isinstance(series.dtype, pd.CategoricalDtype) else series
+        codes, uniques = pd.factorize(values)
+        # Distinct identifiers can resolve to the same URI, so the resolved values are factorized again
+        resolved_codes, categories = pd.factorize(np.array([self.resolve(val) for val in uniques], dtype=object))
+        codes = np.where(codes >= 0, resolved_codes[codes], -1) if len(uniques) else codes
+        return pd.Series(pd.Categorical.from_codes(codes, categories=pd.Index(categories, dtype=object)), index=series.index, name=series.name)
+
+    def save(self, file=None):
+        '''
+        Writes the resolution table to file (default: the cross-walk file), to review or edit it
+        '''
+        file = file or self.crosswalk
+        if not file:
+            raise ValueError("No cross-walk file to save the disease identifiers to")
+        tmp = file + '.tmp'
+        with open(tmp, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['id', 'resolved'])
+            writer.writerows(sorted(self.table.items()))
+        os.replace(tmp, file)
+
+    def _apply_rules(self, val):
+        doid = _DOID_PATTERN.fullmatch(val)
+        if doid:
+            return DOID_BASE + doid.group(1)
+        if self.disqover:
+            if val.startswith(BIOONTOLOGY_PREFIX):
+                var_list = val.split('/')
+                return DISQOVER_BASE + var_list[-2][:-2].lower() + '/' + var_list[-1]
+            if val.startswith(NCI_PREFIX):
+                return DISQOVER_BASE + 'nci/' + val.split('#')[-1]
+        return val
+
+def crosswalk_file(file, disqover):
+    '''
+    Returns the cross-walk file of the mode: file itself, or with a '.disqover' suffix in the DISQOVER mode
+    '''
+    if not file or not disqover:
+        return file
+    root, ext = os.path.splitext(file)
+    return root + '.disqover' + ext
+
+_resolvers = {}
+_resolvers_lock = threading.Lock()
+
+def resolve_disease_ids(series, disqover):
+    '''
+    Input: a pandas.Series of disease identifiers and whether to fit the URIs to DISQOVER
+    Resolves them with a DiseaseIdResolver shared by all calls in the process, so its table is built only once
+    Returns a categorical pandas.Series with the same index
+    '''
+    # Extractors run concurrently, the lock keeps them from creating a resolver each
+    with _resolvers_lock:
+        if disqover not in _resolvers:
+            _resolvers[disqover] = DiseaseIdResolver(disqover)
+    return _resolvers[disqover].resolve_series(series)
+
+def save_crosswalks():
+    '''
+    Writes the tables of the shared resolvers to their cross-walk file, for those that have one
+    Returns the list of written files
+    '''
+    saved = []
+    for resolver in _resolvers.values():
+        if resolver.crosswalk:
+            resolver.save()
+            saved.append(resolver.crosswalk)
+    return saved
@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from urllib.parse import unquote, urlparse
+from instrument import log
+
+'''
+Fetch layer used by the extractors to read remote source files
+Downloads are kept in a content-addressed on-disk cache and revalidated with ETag/Last-Modified
+Settings can be given as arguments or through environment variables:
+    BM_CACHE_DIR  cache directory (default ~/.cache/biomarker)
+    BM_OFFLINE    set to 1 to only use cached files
+    BM_MIRROR     local directory with stand-in files, looked up by the file name of the URL
+    BM_MAX_AGE    seconds during which a cached file is used without revalidation
+'''
+
+class Fetcher:
+    '''
+    Returns local file paths for URLs, downloading them only when the cached copy is missing or outdated
+    Cached files are stored under objects/ by the sha256 of their content,
+    index.json maps every URL to its object and the ETag/Last-Modified headers it was served with
+    One fetcher can be shared between threads, a URL is only checked once per fetcher
+    '''
+    def __init__(self, cache_dir=None, offline=None, mirror=None, max_age=None):
+        self.cache_dir = cache_dir or os.environ.get('BM_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'biomarker')
+        self.offline = offline if offline is not None else os.environ.get('BM_OFFLINE', '0') not in ('', '0')
+        self.mirror = mirror or os.environ.get('BM_MIRROR')
+        if max_age is None and os.environ.get('BM_MAX_AGE'):
+            max_age = float(os.environ['BM_MAX_AGE'])
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._index_file = os.path.join(self.cache_dir, 'index.json')
+        self._index = None
+        self._resolved = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def fetch(self, url):
+        '''
+        Input: a URL, file:// URL or local path
+        Returns the path of a local file with its content
+        Raises FileNotFoundError when in offline mode and the URL is not cached
+        '''
+        parsed = urlparse(url)
+        if parsed.scheme == 'file':
+            return unquote(parsed.netloc + parsed.path)
+        if parsed.scheme not in ('http', 'https'):
+            return url
+        if url in self._resolved:
+            return self._resolved[url]
+        self._resolved[url] = path = self._fetch(url, parsed)
+        return path
+
+    def _fetch(self, url, parsed):
+        if self.mirror:
+            local = os.path.join(self.mirror, os.path.basename(parsed.path))
+            if os.path.exists(local):
+                log("Mirror: "+local)
+                return local
+
+        with self._lock:
+            entry = self._load_index().get(url)
+        cached = entry is not None and os.path.exists(self._object_path(entry))
+        if cached and (self.offline or (self.max_age is not None and time.time() - entry['fetched'] < self.max_age)):
+            return self._hit(url, entry)
+        if self.offline:
+            raise FileNotFoundError("Offline mode: {} is not cached in {}".format(url, self.cache_dir))
+
+        request = urllib.request.Request(url)
+        if cached and entry.get('etag'):
+            request.add_header('If-None-Match', entry['etag'])
+        if cached and entry.get('last_modified'):
+            request.add_header('If-Modified-Since', entry['last_modified'])
+        try:
+            with urllib.request.urlopen(request) as response:
+                entry = self._store(url, response)
+        except urllib.error.HTTPError as e:
+            if cached and e.code == 304:
+                with self._lock:
+                    entry['fetched'] = time.time()
+                    self._save_index()
+                return self._hit(url, entry)
+            raise
+        except urllib.error.URLError:
+            if not cached:
+                raise
+            log("Could not revalidate {}, using cached copy".format(url))
+            return self._hit(url, entry)
+
+        with self._lock:
+            self.misses += 1
+        log("Cache miss: "+url)
+        return self._object_path(entry)
+
+    def _hit(self, url, entry):
+        with self._lock:
+            self.hits += 1
+        log("Cache hit: "+url)
+        return self._object_path(entry)
+
+    def _object_path(self, entry):
+        return os.path.join(self.cache_dir, 'objects', entry['sha256'][:2], entry['sha256'] + entry['suffix'])
+
+    def _store(self, url, response):
+        # Stream the download to a temporary file while hashing it, then move it to its content address
+        os.makedirs(self.cache_dir, exist_ok=True)
+        sha = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=self.cache_dir, delete=False) as tmp:
+            for chunk in iter(lambda: response.read(1 << 20), b''):
+                sha.update(chunk)
+                tmp.write(chunk)
+        entry = {
+            'sha256': sha.hexdigest(),
+            'suffix': os.path.splitext(urlparse(url).path)[1],
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'fetched': time.time(),
+        }
+        path = self._object_path(entry)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.move(tmp.name, path)
+        with self._lock:
+            self._load_index()[url] = entry
+            self._save_index()
+        return entry
+
+    def _load_index(self):
+        if self._index is None:
+            self._index = {}
+            if os.path.exists(self._index_file):
+                with open(self._index_file) as f:
+                    self._index = json.load(f)
+        return self._index
+
+    def _save_index(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=self.cache_dir, suffix='.json', delete=False) as f:
+            json.dump(self._index, f, indent=1)
+        os.replace(f.name, self._index_file)
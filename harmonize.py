@@ -1,91 +1,215 @@
-import os 
-from resource_ext import extract_cbd, extract_oncomx, extract_upbd
+import os
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from columnar import canonical, export_formats, export_table, read_table, write_table
+from disease_ids import save_crosswalks
+from fetch import Fetcher
+from incremental import Manifest, file_sha256
+from instrument import log, stage, start_run
+from linkage import link_biomarkers
+from paths import SOURCES, Paths
+from resource_ext import CBD_URL, ONCOMX_URLS, concat_biomarkers, extract_cbd, extract_oncomx, extract_upbd, extract_sources, to_categorical
+
+'''
+Harmonization pipeline: extracts the sources, merges them into one table and builds the knowledge graph
+The steps can be run one by one (see cli.py) or all at once with `python harmonize.py`
+Importing this module has no side effects; owlready2 is only imported when the knowledge graph is built
+'''
+
+# Harmonized columns, in the order of the exports
+INDEX = [
+        'Id','Name','Usage','Disease','Disease ID','In a panel','Evidence level','Type','Source','Source ID',
+        'Assay/Test','Test manufacturer','Pmid','Molecular type','Molecular ID','Treatment','Description','Clinical trail ID','Components',
+        'Provenance']
 
-warnings.filterwarnings('ignore')
+def _env_flag(name, default='0'):
+    return os.environ.get(name, default) not in ('', '0')
 
 ######################################################################
 #   Extract data from sources and adjust it to the biomarker model   #
 ######################################################################
 
-abspath = os.path.abspath(__file__)
-dname = os.path.dirname(abspath)
-
-# Urine Protein Biomarker Database
-input_file = dname+'/upbd.xls'  
-output_file = dname+'/bm_upbd.csv'
-# Use 'disqover' parameter to fit to subsequent use (in DISQOVER or in Ontology model)
-df_upbd = extract_upbd(input_file,output_file,disqover=False)
-
-# Oncomx FDA Biomarkers
-output_file = dname+'/bm_oncomx.json'
-df_oncomx = extract_oncomx(output_file,disqover=False)
-
-# Colorectal cancer biomarker database
-output_file = dname+'/bm_cbd.json'
-df_cbd = extract_cbd(output_file,disqover=False)
-
-
-# Merge data from different sources
-df_upbd['Id'] = 'upbd_'+ df_upbd['Id'].astype(str)
-df_oncomx['Id'] = 'oncomx_'+ df_oncomx['Id'].astype(str)
-df_cbd['Id'] = 'cbd_'+ df_cbd['Id'].astype(str)
- 
-merged = df_upbd.append(df_oncomx).append(df_cbd)
-index = [
-        'Id','Name','Usage','Disease','Disease ID','In a panel','Evidence level','Type','Source','Source ID',
-        'Assay/Test','Test manufacturer','Pmid','Molecular type','Molecular ID','Treatment','Description','Clinical trail ID']
-merged.to_excel('merged.xlsx',columns = index, index = False)
+def extract(paths, sources=SOURCES, full_rebuild=False, disqover=False, fetcher=None, manifest=None):
+    '''
+    Extracts the given sources to their Parquet files, concurrently, sharing one download cache
+    Sources whose input files did not change since their last extraction are skipped unless full_rebuild
+    Every source fetches and checks its own inputs, so a source that cannot be fetched fails alone
+    Use 'disqover' parameter to fit to subsequent use (in DISQOVER or in Ontology model)
+    Returns the names of the extracted sources
+    '''
+    fetcher = fetcher or Fetcher()
+    manifest = manifest or Manifest(paths.manifest)
+    jobs = {
+        # Urine Protein Biomarker Database
+        # set BM_CHUNKSIZE to stream large dumps in chunks of that many rows
+        'upbd': (extract_upbd, (paths.upbd_file, paths.source('upbd')), {'disqover':disqover, 'fetcher':fetcher, 'chunksize':int(os.environ.get('BM_CHUNKSIZE', 0)) or None}),
+        # Oncomx FDA Biomarkers
+        'oncomx': (extract_oncomx, (paths.source('oncomx'),), {'disqover':disqover, 'fetcher':fetcher}),
+        # Colorectal cancer biomarker database
+        'cbd': (extract_cbd, (paths.source('cbd'),), {'disqover':disqover, 'fetcher':fetcher}),
+    }
+    inputs = {'upbd': [paths.upbd_file], 'oncomx': ONCOMX_URLS, 'cbd': [CBD_URL]}
+    input_hashes = {}
+    unchanged = []
+
+    def check_and_extract(name):
+        # Skip the source if its input files did not change since the previous run
+        func, args, kwargs = jobs[name]
+        with stage('check inputs'):
+            with ThreadPoolExecutor(max_workers=len(inputs[name])) as pool:
+                files = list(pool.map(fetcher.fetch, inputs[name]))
+            hashes = {url: file_sha256(file) for url, file in zip(inputs[name], files)}
+            # The mode is recorded with the inputs, so switching it extracts the sources again
+            hashes['mode'] = 'disqover' if disqover else 'ontology'
+            input_hashes[name] = hashes
+            if not full_rebuild and manifest.unchanged(name, hashes) and os.path.exists(paths.source(name)):
+                log("{} is unchanged, reusing the previous extraction".format(name))
+                unchanged.append(name)
+                return None
+        return func(*args, **kwargs)
+
+    with stage('extract') as extracting:
+        extracted = extract_sources({name: (check_and_extract, (name,), {}) for name in sources})
+        extracting.info['unchanged'] = [name for name in sources if name in unchanged]
+    # The identifiers seen are persisted in the disease cross-walk file (BM_DISEASE_XWALK), if one is set
+    for file in save_crosswalks():
+        log("Disease identifiers saved to "+file)
+
+    # Failed sources keep their previous Parquet file
+    done = [name for name, df in extracted.items() if df is not None and name not in unchanged]
+    for name in done:
+        manifest.record(name, input_hashes[name])
+    manifest.save()
+    return done
+
+def merge(paths, disqover=False, manifest=None):
+    '''
+    Merges the extracted sources into the harmonized table (merged.parquet), linking duplicate biomarkers
+    The Ids changed since the last merge are recorded in the manifest, for build_kg to update only those
+    Returns the merged DataFrame
+    '''
+    manifest = manifest or Manifest(paths.manifest)
+    dfs = []
+    with stage('merge') as merging:
+        for name in SOURCES:
+            if not os.path.exists(paths.source(name)):
+                continue
+            df = to_categorical(read_table(paths.source(name)), disqover)
+            df['Id'] = name+'_'+ df['Id'].astype(str)
+            merging.rows(rows_in=len(df))
+            dfs.append(df)
+        if not dfs:
+            raise FileNotFoundError("No extracted sources in "+paths.data_dir)
+        # Values are made canonical, so rows hash the same whichever source types they come with
+        stacked = canonical(concat_biomarkers(dfs))
+        merging.rows(rows_out=len(stacked))
+
+    # The same biomarker reported by several sources (or several times by one) is merged into one
+    with stage('link', rows_in=len(stacked)) as link:
+        merged = link_biomarkers(stacked)
+        link.rows(rows_out=len(merged))
+        link.info['linked rows'] = len(stacked) - len(merged)
+    log("\n{} rows linked into {} biomarkers".format(len(stacked), len(merged)))
+
+    # Row level changes against the previous run
+    with stage('diff', rows_in=len(merged)) as diff:
+        added, updated, deleted = manifest.diff(merged, INDEX)
+        manifest.stale.update(added + updated + deleted)
+        diff.info.update({'added': len(added), 'updated': len(updated), 'deleted': len(deleted)})
+    log("\n{} added, {} updated and {} deleted biomarkers".format(len(added), len(updated), len(deleted)))
+    if added or updated or deleted or not os.path.exists(paths.merged):
+        # merged.parquet is the harmonized table, BM_EXPORTS=1 also exports it as merged.xlsx
+        with stage('write', rows_in=len(merged)):
+            write_table(merged, paths.merged)
+        with stage('export'):
+            export_table(merged, paths.merged, export_formats(['xlsx']), columns = INDEX)
+    manifest.save()
+    return merged
 
 ############################################################
-#   Creating individuals using biomarker ontology model    #   
+#   Creating individuals using biomarker ontology model    #
 ############################################################
 
-from owlready2 import *
-import pandas as pd
-
-print("Loading Biomarker ontology..")
-biomarker = get_ontology("file://D:/ontoforce/model/bm_model.owl").load()
-
-# Creating new individuals in biomarker ontology for OncoMX biomarkers
-print("Creating individuals..")
-
-# Iterate over merged data and extract relevant information
-# Use information to create objects and describe their relationships
-for index, row in merged.iterrows():
-
-    # Create instances of classes
-    bm_usage = row['Usage'].split('|')
-    disease = biomarker.Disease(row['Disease ID'])
-    disease.label = row['Disease']
-    source = biomarker.AnatomicalEntity(row['Source ID'])
-    source.label = row['Source']
-    assay = biomarker.AssayTest(row['Assay/Test'])
-    new_bm = biomarker.MolecularBM(row['Id'])
-    new_bm.label = row['Name']
-    
-    # Create relations between instances (object properties)
-    for item in bm_usage:
-        usage = 'biomarker.'+item
-        new_bm.is_a.append(eval(usage))
-    new_bm.indicatorOf.append(disease) 
-    new_bm.measuredIn.append(source)
-    new_bm.measuredBy.append(assay)
-
-    # Some information is not provided for all biomarkers
-    molecular_type = row['Molecular type']
-    molecular_id = row['Molecular ID']
-    evidence_level = row['Evidence level']
-    desc = row['Description']
-    pmid = row['Pmid']
-    if not pd.isnull(evidence_level) : new_bm.hasEvidenceLevel.append(evidence_level)
-    if not pd.isnull(desc): new_bm.hasDescription.append(desc)
-    if not pd.isnull(molecular_type): new_bm.hasMolecularType.append(molecular_type)
-    if not pd.isnull(molecular_id): new_bm.hasMolecularID.append(molecular_id)
-    if not pd.isnull(pmid): 
-        publication = biomarker.Publication(str(pmid))
-        new_bm.hasEvidence.append(publication)
-
-print('Saving to file')
-biomarker.save(file='D:/ontoforce/model/bm_db.owl',format='rdfxml')
-
+def build_kg(paths, merged=None, full_rebuild=False, manifest=None):
+    '''
+    Builds the knowledge graph store from the harmonized table (default: read from merged.parquet)
+    The store is rebuilt if full_rebuild or missing, otherwise only the biomarkers changed since the last build
+    The RDF/XML export can be turned off with BM_EXPORT_RDFXML=0,
+    BM_EXPORT_NT=1 also streams it to gzipped N-Triples, one file per source
+    '''
+    from kg_builder import add_biomarkers, load_biomarkers, open_kg, remove_biomarkers
+    from ntriples import write_ntriples
+    manifest = manifest or Manifest(paths.manifest)
+    if merged is None:
+        merged = load_biomarkers(paths.merged)
+
+    rebuild = full_rebuild or not os.path.exists(paths.store)
+    stale = sorted(manifest.stale)
+    if rebuild:
+        if os.path.exists(paths.store):
+            os.remove(paths.store)
+        with stage('load ontology'):
+            log("Loading Biomarker ontology..")
+            world, biomarker = open_kg(paths.store, paths.model)
+        with stage('create individuals', rows_in=len(merged)) as create:
+            log("Creating individuals..")
+            add_biomarkers(biomarker, merged)
+            create.rows(rows_out=len(merged))
+    elif stale:
+        # Only the changed biomarkers are rebuilt in the previous knowledge graph
+        with stage('load ontology'):
+            log("Opening knowledge graph store..")
+            world, biomarker = open_kg(paths.store)
+        changed = merged[merged['Id'].isin(stale)]
+        with stage('create individuals', rows_in=len(changed)) as create:
+            log("Updating individuals..")
+            remove_biomarkers(biomarker, stale)
+            add_biomarkers(biomarker, changed)
+            create.rows(rows_out=len(changed))
+            create.info['removed'] = len(stale)
+    else:
+        log("The knowledge graph is up to date")
+        return
+
+    with stage('save'):
+        log('Saving to '+paths.store)
+        world.save()
+        if _env_flag('BM_EXPORT_RDFXML', '1'):
+            with stage('rdfxml'):
+                log('Saving to '+paths.rdfxml)
+                biomarker.save(file=paths.rdfxml,format='rdfxml')
+        if _env_flag('BM_EXPORT_NT'):
+            with stage('ntriples', rows_in=len(merged)):
+                log('Writing N-Triples..')
+                for file in write_ntriples(merged, biomarker.base_iri, paths.ntriples, shard=True):
+                    log('Saved to '+file)
+        world.close()
+    manifest.stale.clear()
+    manifest.save()
+
+def run(paths=None, full_rebuild=None, disqover=False):
+    '''
+    Runs the whole pipeline: extract all sources, merge them and build the knowledge graph
+    Every stage is recorded in a JSON run report (BM_REPORT), BM_PROFILE=1 adds cProfile and tracemalloc capture
+    full_rebuild (default: BM_FULL_REBUILD) extracts all sources again and rebuilds the knowledge graph
+    Use 'disqover' parameter to fit to subsequent use (in DISQOVER or in Ontology model),
+    the knowledge graph is only built in the ontology mode as the DISQOVER labels are not ontology classes
+    '''
+    paths = paths or Paths()
+    if full_rebuild is None:
+        full_rebuild = _env_flag('BM_FULL_REBUILD')
+    report = start_run()
+    manifest = Manifest(paths.manifest)
+    extract(paths, full_rebuild=full_rebuild, disqover=disqover, manifest=manifest)
+    merged = merge(paths, disqover=disqover, manifest=manifest)
+    if disqover:
+        log("\nThe knowledge graph is not built from DISQOVER tables")
+    else:
+        build_kg(paths, merged, full_rebuild=full_rebuild, manifest=manifest)
+    report.write(paths.report)
+    print("\n"+report.summary())
+    print("Run report written to "+paths.report)
+
+if __name__ == "__main__":
+    warnings.filterwarnings('ignore')
+    run()
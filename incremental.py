@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+import pandas as pd
+
+'''
+Manifest for incremental harmonization
+Records a content hash for the input files of every source and for every extracted row,
+so unchanged sources are not extracted again and only changed biomarkers are rebuilt in the ontology
+'''
+
+def file_sha256(path):
+    '''
+    Returns the sha256 hex digest of a local file
+    '''
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def row_hashes(df, columns):
+    '''
+    Input: a pandas.DataFrame containing an 'Id' column and the columns to hash
+    Returns a dictionary mapping every Id to the hash of its row
+    '''
+    # Missing columns hash as missing values, so frames with different column sets stay comparable
+    hashes = pd.util.hash_pandas_object(df.reindex(columns=columns).astype(object), index=False)
+    return dict(zip(df['Id'].astype(str), ('{:016x}'.format(h) for h in hashes)))
+
+class Manifest:
+    '''
+    Input hashes and row hashes of the previous run, and the Ids changed since the knowledge graph was last built,
+    stored as JSON: {"sources": {name: {"inputs": {file: sha256}, "rows": {Id: hash}}}, "stale": [Id]}
+    '''
+    def __init__(self, file):
+        self.file = file
+        self.sources = {}
+        self.stale = set()
+        if os.path.exists(file):
+            with open(file) as f:
+                manifest = json.load(f)
+            self.sources = manifest['sources']
+            self.stale = set(manifest.get('stale', []))
+
+    def unchanged(self, name, inputs):
+        '''
+        Returns True if the source was recorded with exactly the same input hashes
+        '''
+        return name in self.sources and self.sources[name]['inputs'] == inputs
+
+    def record(self, name, inputs):
+        '''
+        Records the input hashes of a source, its rows are recorded by diff()
+        '''
+        self.sources.setdefault(name, {'inputs': {}, 'rows': {}})['inputs'] = inputs
+
+    def diff(self, merged, columns):
+        '''
+        Input: the merged pandas.DataFrame of this run and the columns to compare
+        Compares every row to the previous run by Id and records the new row hashes
+        Returns (added, updated, deleted) lists of Ids
+        '''
+        new_rows = row_hashes(merged, columns)
+        old_rows = {}
+        for source in self.sources.values():
+            old_rows.update(source['rows'])
+
+        added = [bm_id for bm_id in new_rows if bm_id not in old_rows]
+        updated = [bm_id for bm_id, h in new_rows.items() if bm_id in old_rows and old_rows[bm_id] != h]
+        deleted = [bm_id for bm_id in old_rows if bm_id not in new_rows]
+
+        for name, source in self.sources.items():
+            source['rows'] = {bm_id: h for bm_id, h in new_rows.items() if bm_id.startswith(name+'_')}
+        return added, updated, deleted
+
+    def save(self):
+        tmp = self.file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'sources': self.sources, 'stale': sorted(self.stale)}, f)
+        os.replace(tmp, self.file)
@@ -0,0 +1,247 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+'''
+Stage-level instrumentation of the harmonization run
+Every extractor and pipeline stage runs in a stage() block recording its wall time, rows in and out,
+dropped rows by reason and the peak RSS of the process when it ended; messages go through log()
+The stages of a run are written as a JSON run report by RunReport.write()
+BM_PROFILE turns on extra capture: 'cprofile' (one .prof file per top-level stage in BM_PROFILE_DIR, default
+'profiles', and its slowest functions in the report), 'tracemalloc' (traced peak memory per stage and the largest
+allocation sites), or 1 for both
+'''
+
+def peak_rss_mb():
+    '''
+    Returns the peak resident set size of the process in MB, or None where it cannot be read
+    '''
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return round(peak / (2**20 if sys.platform == 'darwin' else 2**10), 1)
+    except ImportError:
+        pass
+    try:
+        import psutil
+        return round(psutil.Process().memory_info().peak_wset / 2**20, 1)
+    except (ImportError, AttributeError):
+        return None
+
+class Stage:
+    '''
+    Measurements of one stage, accumulated over all the times it is entered
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.rows_in = None
+        self.rows_out = None
+        self.dropped = {}
+        self.info = {}
+        self.messages = []
+        self.peak_rss_mb = None
+        self.traced_peak_mb = None
+        self.error = None
+
+    def rows(self, rows_in=None, rows_out=None):
+        '''
+        Adds to the rows going into and out of the stage
+        '''
+        if rows_in is not None:
+            self.rows_in = (self.rows_in or 0) + int(rows_in)
+        if rows_out is not None:
+            self.rows_out = (self.rows_out or 0) + int(rows_out)
+
+    def drop(self, count, total, reason):
+        '''
+        Records count dropped rows out of total for reason (e.g. 'rows with more than one source') and logs it
+        '''
+        self.dropped[reason] = self.dropped.get(reason, 0) + int(count)
+        percent = round(count/total*100,2) if total else 0
+        log("Dropped {} ({}%) {}".format(count, percent, reason))
+
+    def as_dict(self):
+        record = {'name': self.name, 'calls': self.calls, 'seconds': round(self.seconds, 4),
+                  'rows_in': self.rows_in, 'rows_out': self.rows_out, 'dropped': self.dropped,
+                  'peak_rss_mb': self.peak_rss_mb}
+        if self.traced_peak_mb is not None:
+            record['traced_peak_mb'] = self.traced_peak_mb
+        if self.info:
+            record['info'] = self.info
+        if self.messages:
+            record['messages'] = self.messages
+        if self.error:
+            record['error'] = self.error
+        return record
+
+class RunReport:
+    '''
+    Collects the stages of one run, from any thread
+    profile: a set of 'cprofile' and 'tracemalloc' (default: read from BM_PROFILE)
+    '''
+    def __init__(self, profile=None):
+        if profile is None:
+            value = os.environ.get('BM_PROFILE', '0').lower()
+            profile = {'cprofile', 'tracemalloc'} if value in ('1', 'all') else set(value.split(',')) - {'', '0'}
+        self.profile = set(profile)
+        self.started = time.time()
+        self.stages = {}
+        self.profiles = {}
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._active = 0
+        if 'tracemalloc' in self.profile and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def get(self, name):
+        with self._lock:
+            if name not in self.stages:
+                self.stages[name] = Stage(name)
+            return self.stages[name]
+
+    def as_dict(self):
+        report = {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'wall_seconds': round(time.perf_counter() - self._start, 4),
+            'peak_rss_mb': peak_rss_mb(),
+            'stages': [stage.as_dict() for stage in self.stages.values()],
+        }
+        if self.profiles:
+            report['profiles'] = self.profiles
+        if tracemalloc.is_tracing():
+            top = tracemalloc.take_snapshot().statistics('lineno')[:10]
+            report['largest_allocations'] = [{'site': str(stat.traceback), 'mb': round(stat.size / 2**20, 2)} for stat in top]
+        return report
+
+    def write(self, file):
+        '''
+        Writes the run report as JSON to file and returns it as a dictionary
+        '''
+        report = self.as_dict()
+        with open(file, 'w') as f:
+            json.dump(report, f, indent=1)
+        return report
+
+    def summary(self):
+        '''
+        Returns a table of the top-level stages: time, rows in and out and dropped rows
+        '''
+        lines = ["stage\tseconds\trows in\trows out\tdropped"]
+        for stage in self.stages.values():
+            if '/' not in stage.name:
+                lines.append("{}\t{:.2f}s\t{}\t{}\t{}".format(stage.name, stage.seconds, _blank(stage.rows_in),
+                                                        _blank(stage.rows_out), sum(stage.dropped.values()) or ''))
+        return '\n'.join(lines)
+
+def _blank(value):
+    return '' if value is None else value
+
+_report = RunReport(profile=())
+_local = threading.local()
+
+def start_run(profile=None):
+    '''
+    Starts a new run report, that all following stages are recorded in
+    Returns the RunReport
+    '''
+    global _report
+    _report = RunReport(profile)
+    return _report
+
+def current_run():
+    return _report
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+@contextmanager
+def stage(name, rows_in=None):
+    '''
+    Measures the block as a stage of the current run, nested stages are named 'parent/name'
+    Yields the Stage, to record rows and dropped rows
+    '''
+    report = _report
+    stack = _stack()
+    record = report.get('/'.join([s.name for s in stack[-1:]] + [name]))
+    record.rows(rows_in)
+    profiler = None
+    top_level = not stack
+    if top_level and 'cprofile' in report.profile:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is active in this process (Python 3.12+ with concurrent stages)
+            profiler = None
+    with report._lock:
+        alone = report._active == 0
+        report._active += 1
+    if alone and tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    stack.append(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record.error = '{}: {}'.format(type(e).__name__, e)
+        raise
+    finally:
+        record.seconds += time.perf_counter() - start
+        record.calls += 1
+        stack.pop()
+        with report._lock:
+            report._active -= 1
+        record.peak_rss_mb = peak_rss_mb()
+        # The traced peak is only attributable to the stage when no other stage ran concurrently
+        if alone and tracemalloc.is_tracing():
+            record.traced_peak_mb = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+        if profiler is not None:
+            profiler.disable()
+            _save_profile(report, record.name, profiler)
+
+def _save_profile(report, name, profiler):
+    out = io.StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    stats.sort_stats('cumulative').print_stats(15)
+    file = os.environ.get('BM_PROFILE_DIR', 'profiles')
+    os.makedirs(file, exist_ok=True)
+    file = os.path.join(file, name.replace(' ', '_') + '.prof')
+    stats.dump_stats(file)
+    with report._lock:
+        report.profiles[name] = {'file': file, 'top': out.getvalue().splitlines()}
+
+def iterate(name, iterable, rows=len):
+    '''
+    Iterates over iterable, measuring every step as the stage name and counting rows(item) rows out of it
+    Used for readers yielding chunks, so reading is measured separately from processing the chunks
+    '''
+    iterator = iter(iterable)
+    while True:
+        with stage(name) as record:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            record.rows(rows_out=rows(item))
+        yield item
+
+def log(message):
+    '''
+    Prints message and keeps it with the innermost stage of the current thread
+    '''
+    print(message)
+    stack = _stack()
+    if stack:
+        stack[-1].messages.append(message.strip())
@@ -0,0 +1,162 @@
+import os
+from owlready2 import World, destroy_entity, label, owl_named_individual, rdf_type
+
+'''
+Functions creating and removing biomarker individuals in the biomarker ontology
+Individuals are written in bulk as triples into the owlready2 quadstore,
+which is persisted as an SQLite file so the knowledge graph can be queried without parsing RDF/XML
+pandas and pyarrow are only imported by the functions building the graph, so opening it for queries stays light
+'''
+
+rdfs_label = label.storid
+
+# Optional biomarker information: (column, data property)
+DATA_PROPERTIES = [
+    ('Evidence level', 'hasEvidenceLevel'),
+    ('Description', 'hasDescription'),
+    ('Molecular type', 'hasMolecularType'),
+    ('Molecular ID', 'hasMolecularID'),
+]
+
+# Object properties linking biomarkers to the shared individuals (diseases, sources, assays, publications)
+SHARED_PROPERTIES = ['indicatorOf', 'measuredIn', 'measuredBy', 'hasEvidence']
+
+# Columns of the harmonized table used to build the knowledge graph
+KG_COLUMNS = ['Id','Name','Usage','Disease','Disease ID','Source','Source ID','Assay/Test','Pmid'] + [col for col, prop in DATA_PROPERTIES]
+
+def load_biomarkers(table_file):
+    '''
+    Reads the columns needed for the knowledge graph from the harmonized table (merged.parquet)
+    Returns a pandas.DataFrame
+    '''
+    from columnar import read_table
+    return read_table(table_file, columns=KG_COLUMNS)
+
+def open_kg(store_file, model_file=None, read_only=False):
+    '''
+    Opens the knowledge graph persisted in an owlready2 SQLite quadstore (store_file)
+    A new store is created with the biomarker ontology loaded from model_file
+    With read_only the store is opened without locking it, for querying
+    Returns (world, biomarker ontology)
+    '''
+    new_store = not os.path.exists(store_file)
+    if new_store and (read_only or model_file is None):
+        raise FileNotFoundError("No knowledge graph store at "+store_file)
+    world = World(filename=store_file, exclusive=not read_only, read_only=read_only)
+    if new_store:
+        biomarker = world.get_ontology("file://"+model_file).load()
+    else:
+        biomarker = world.search_one(iri='*#Biomarker').namespace.ontology
+    if read_only:
+        # End the transaction left open while loading, so readers neither block writers nor miss their changes
+        world.graph.db.commit()
+    return world, biomarker
+
+def usage_classes(biomarker):
+    '''
+    Returns a dictionary mapping the names of the usage classes (e.g. 'DiagnosticBM') to their storid
+    '''
+    return {cls.name: cls.storid for cls in biomarker.BiomarkerUsage.descendants()}
+
+class _Triples:
+    '''
+    Collects object and data triples for one ontology and writes them with one executemany per table
+    Entities are interned: every IRI is abbreviated and typed only once
+    '''
+    def __init__(self, biomarker):
+        self.onto = biomarker
+        self.c = biomarker.graph.c
+        self.objs = []
+        self.datas = []
+        self.storids = {}
+
+    def entity(self, name, cls):
+        storid = self.storids.get(name)
+        if storid is None:
+            storid = self.storids[name] = self.onto._abbreviate(self.onto.base_iri + name)
+            self.objs.append((self.c, storid, rdf_type, owl_named_individual))
+            self.objs.append((self.c, storid, rdf_type, cls.storid))
+        return storid
+
+    def obj(self, s, p, o):
+        self.objs.append((self.c, s, p, o))
+
+    def data(self, s, p, value):
+        o, d = self.onto._to_rdf(value)
+        self.datas.append((self.c, s, p, o, d))
+
+    def write(self):
+        db = self.onto.graph.db
+        db.executemany("INSERT OR IGNORE INTO objs VALUES (?,?,?,?)", self.objs)
+        db.executemany("INSERT OR IGNORE INTO datas VALUES (?,?,?,?,?)", self.datas)
+
+def add_biomarkers(biomarker, df):
+    '''
+    Input: the loaded biomarker ontology and a pandas.DataFrame of harmonized biomarkers (as in merged.xlsx)
+    Creates an individual for every row and describes its relationships
+    Diseases, sources, assays and publications are created once and shared by their biomarkers,
+    they get the label of the last row referring to them
+    '''
+    import pandas as pd
+    triples = _Triples(biomarker)
+    usages = usage_classes(biomarker)
+    props = {name: biomarker[name].storid for name in SHARED_PROPERTIES}
+    data_props = [(col, biomarker[prop].storid) for col, prop in DATA_PROPERTIES]
+
+    # Shared entities with their labels, the last label wins as with repeated 'entity.label = ...'
+    labels = {}
+    for id_col, label_col, cls in [('Disease ID','Disease',biomarker.Disease), ('Source ID','Source',biomarker.AnatomicalEntity)]:
+        for name, value in df.drop_duplicates(id_col, keep='last')[[id_col, label_col]].itertuples(index=False):
+            labels[triples.entity(name, cls)] = value
+    # Replace the labels the shared entities may already have in the ontology
+    biomarker.graph.db.executemany("DELETE FROM datas WHERE c=? AND s=? AND p=?", [(triples.c, s, rdfs_label) for s in labels])
+    for s, value in labels.items():
+        triples.data(s, rdfs_label, value)
+
+    cols = ['Id','Name','Usage','Disease ID','Source ID','Assay/Test','Pmid'] + [col for col, prop in data_props]
+    for row in df[cols].itertuples(index=False, name=None):
+        bm_id, name, bm_usage, disease_id, source_id, assay, pmid = row[:7]
+        new_bm = triples.entity(bm_id, biomarker.MolecularBM)
+        triples.data(new_bm, rdfs_label, name)
+
+        # Create relations between instances (object properties)
+        for item in dict.fromkeys(bm_usage.split('|')):
+            if item not in usages:
+                raise ValueError("Unknown usage '{}' for biomarker {}".format(item, bm_id))
+            triples.obj(new_bm, rdf_type, usages[item])
+        triples.obj(new_bm, props['indicatorOf'], triples.storids[disease_id])
+        triples.obj(new_bm, props['measuredIn'], triples.storids[source_id])
+        # Linked biomarkers list the assays and PMIDs of all their sources, separated by '|'
+        for item in dict.fromkeys(str(assay).split('|')):
+            triples.obj(new_bm, props['measuredBy'], triples.entity(item, biomarker.AssayTest))
+
+        # Some information is not provided for all biomarkers
+        for (col, prop), value in zip(data_props, row[7:]):
+            if not pd.isnull(value): triples.data(new_bm, prop, value)
+        if not pd.isnull(pmid):
+            for item in dict.fromkeys(str(pmid).split('|')):
+                triples.obj(new_bm, props['hasEvidence'], triples.entity(item, biomarker.Publication))
+
+    triples.write()
+
+def remove_biomarkers(biomarker, ids):
+    '''
+    Input: the loaded biomarker ontology and biomarker ids (e.g. 'upbd_4f1c2b9a0d3e5f67')
+    Destroys the biomarker individuals and all their relations
+    Shared individuals (diseases, sources, assays, publications) no other biomarker refers to are deleted as well,
+    so the store holds the same triples as one built from scratch
+    '''
+    db = biomarker.graph.db
+    c = biomarker.graph.c
+    props = [biomarker[name].storid for name in SHARED_PROPERTIES]
+    query = "SELECT o FROM objs WHERE c=? AND s=? AND p IN ({})".format(','.join('?'*len(props)))
+    shared = set()
+    for bm_id in ids:
+        individual = biomarker[bm_id]
+        if individual is not None:
+            shared.update(o for (o,) in db.execute(query, (c, individual.storid, *props)))
+            destroy_entity(individual)
+    for storid in shared:
+        if db.execute("SELECT 1 FROM objs WHERE o=? LIMIT 1", (storid,)).fetchone() is None:
+            db.execute("DELETE FROM objs WHERE c=? AND s=?", (c, storid))
+            db.execute("DELETE FROM datas WHERE c=? AND s=?", (c, storid))
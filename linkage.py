@@ -0,0 +1,89 @@
+import re
+import numpy as np
+import pandas as pd
+from resource_ext import _map_unique
+
+'''
+Linkage of duplicate biomarkers across sources
+Rows are put in blocks by a 64-bit hash of their normalized (molecule, disease, usage, source) key, and only rows
+sharing a block are compared, so the cost grows with the number of rows rather than the number of row pairs
+Matching rows are merged into one biomarker that keeps the Ids of all of them as provenance
+'''
+
+# Columns whose values may differ between matching rows, they are joined by '|' so no row loses its value
+JOINED_COLUMNS = [
+    'In a panel', 'Evidence level', 'Assay/Test', 'Test manufacturer', 'Pmid', 'Molecular type', 'Molecular ID',
+    'Treatment', 'Description', 'Clinical trail ID', 'Location']
+# The other columns only differ by spelling between matching rows (names, disease labels), the first value is kept
+
+_TOKEN_SEP = re.compile(r'[|,]')
+
+def _norm_tokens(val):
+    # Case, spacing and the order of '|' (or ',') separated items do not matter
+    return '|'.join(sorted({' '.join(tok.split()).lower() for tok in _TOKEN_SEP.split(str(val))} - {''}))
+
+def _join_unique(values):
+    joined = '|'.join(dict.fromkeys(tok for val in values.dropna() for tok in str(val).split('|')))
+    return joined or np.nan
+
+def link_keys(df):
+    '''
+    Input: a pandas.DataFrame of harmonized biomarkers
+    Returns a DataFrame with the normalized linkage key of every row:
+    the molecule name, disease ID, usage and source
+    Molecules are keyed by their name (gene symbol or protein name) in every source, as not all sources give
+    a molecular ID; panels are keyed by the names of all their participants
+    '''
+    return pd.DataFrame({
+        'molecule': _map_unique(df['Name'].astype(object), _norm_tokens),
+        'disease': _map_unique(df['Disease ID'].astype(object), _norm_tokens),
+        'usage': _map_unique(df['Usage'].astype(object), _norm_tokens),
+        'source': _map_unique(df['Source'].astype(object), _norm_tokens),
+    }, index=df.index)
+
+def link_biomarkers(df):
+    '''
+    Input: a pandas.DataFrame of harmonized biomarkers from one or more sources, with unique Ids
+    Merges the rows with the same linkage key (see link_keys) into one biomarker
+    The first row keeps its Id and values, its missing values are taken from the other rows,
+    the columns in JOINED_COLUMNS (assays, PMIDs, descriptions, ...) join the values of all rows by '|'
+    and the new 'Provenance' column joins their Ids by '|'
+    Returns the linked DataFrame, with the remaining rows in their original order
+    '''
+    keys = link_keys(df)
+    blocks = pd.util.hash_pandas_object(keys, index=False).to_numpy()
+    positions = np.arange(len(df))
+    cluster = positions.copy()
+
+    # Blocking index: block hash -> first rows of the clusters in that block
+    # Only rows sharing a block with another row are candidates, they are compared on their full key
+    candidates = np.flatnonzero(pd.Series(blocks).duplicated(keep=False).to_numpy())
+    key_tuples = list(keys.iloc[candidates].itertuples(index=False, name=None))
+    index = {}
+    for pos, key in zip(candidates, key_tuples):
+        firsts = index.setdefault(blocks[pos], [])
+        for first, first_key in firsts:
+            if first_key == key:
+                cluster[pos] = first
+                break
+        else:
+            firsts.append((pos, key))
+
+    ids = df['Id'].astype(str).to_numpy()
+    linked = df.reset_index(drop=True)
+    linked['Provenance'] = ids
+    merged = cluster != positions
+    if merged.any():
+        in_group = np.isin(cluster, cluster[merged])
+        group = cluster[in_group]
+        rows = linked[in_group]
+        combined = rows.groupby(group, sort=False).first()
+        for col in JOINED_COLUMNS:
+            if col in rows:
+                linked[col] = linked[col].astype(object)
+                combined[col] = rows[col].groupby(group, sort=False).agg(_join_unique)
+        combined['Provenance'] = rows['Provenance'].groupby(group, sort=False).agg('|'.join)
+        linked.loc[combined.index, combined.columns] = combined
+    linked = linked[~merged]
+    linked.index = df.index[~merged]
+    return linked
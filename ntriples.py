@@ -0,0 +1,95 @@
+import gzip
+import os
+from urllib.parse import quote
+import pandas as pd
+from kg_builder import DATA_PROPERTIES
+
+'''
+Streaming N-Triples export of the harmonized biomarkers
+Triples are written row by row while walking the merged table, so nothing is kept in memory but
+the shared entities already written; the output can be split in one file per source ('upbd', 'oncomx', 'cbd')
+'''
+
+RDF_TYPE = '<http://www.w3.org/1999/02/22-rdf-syntax-ns#type>'
+RDFS_LABEL = '<http://www.w3.org/2000/01/rdf-schema#label>'
+OWL_NAMED_INDIVIDUAL = '<http://www.w3.org/2002/07/owl#NamedIndividual>'
+
+# Characters allowed in an N-Triples IRI, others (spaces, '|', ...) are percent-encoded
+_IRI_SAFE = "!#$%&'()*+,-./:;=?@[]_~"
+
+def iri(base_iri, name):
+    return '<' + quote(base_iri + str(name), safe=_IRI_SAFE) + '>'
+
+def literal(value):
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').replace('\r', '\\r')
+    return '"' + value + '"'
+
+class _Shard:
+    '''
+    One output file and the shared entities already written to it
+    '''
+    def __init__(self, file):
+        self.file = file
+        self.out = gzip.open(file, 'wt', encoding='utf-8') if file.endswith('.gz') else open(file, 'w', encoding='utf-8')
+        self.seen = set()
+
+    def entity(self, subject, cls, label=None, shared=True):
+        if not shared or subject not in self.seen:
+            if shared:
+                self.seen.add(subject)
+            self.out.write('{} {} {} .\n{} {} {} .\n'.format(subject, RDF_TYPE, OWL_NAMED_INDIVIDUAL, subject, RDF_TYPE, cls))
+            if label is not None:
+                self.out.write('{} {} {} .\n'.format(subject, RDFS_LABEL, literal(label)))
+        return subject
+
+def write_ntriples(df, base_iri, output, shard=False):
+    '''
+    Input: a pandas.DataFrame of harmonized biomarkers (as in merged.xlsx), the base IRI of the biomarker ontology
+    and the output file ('.nt', or '.nt.gz' for gzip compression)
+    Writes the same individuals and relations as kg_builder.add_biomarkers, as N-Triples
+    IRIs are percent-encoded where names contain characters N-Triples does not allow (e.g. spaces)
+    With shard, every source gets its own file named after the Id prefix, e.g. bm_db.upbd.nt.gz
+    Every file then contains the diseases, sources, assays and publications its biomarkers refer to
+    Returns the list of written files
+    '''
+    iri_of = lambda name: iri(base_iri, name)
+    disease_cls, source_cls, assay_cls, publication_cls, bm_cls = [
+        iri_of(name) for name in ['Disease', 'AnatomicalEntity', 'AssayTest', 'Publication', 'MolecularBM']]
+    indicator_of, measured_in, measured_by, has_evidence = [
+        iri_of(name) for name in ['indicatorOf', 'measuredIn', 'measuredBy', 'hasEvidence']]
+    data_props = [iri_of(prop) for col, prop in DATA_PROPERTIES]
+
+    # Shared entities get the label of the last row referring to them, as in the ontology
+    disease_labels = dict(df[['Disease ID', 'Disease']].itertuples(index=False))
+    source_labels = dict(df[['Source ID', 'Source']].itertuples(index=False))
+
+    stem = output[:-len('.nt.gz')] if output.endswith('.nt.gz') else os.path.splitext(output)[0]
+    suffix = output[len(stem):]
+    shards = {}
+    try:
+        cols = ['Id','Name','Usage','Disease ID','Source ID','Assay/Test','Pmid'] + [col for col, prop in DATA_PROPERTIES]
+        for row in df[cols].itertuples(index=False, name=None):
+            bm_id, name, bm_usage, disease_id, source_id, assay, pmid = row[:7]
+            key = bm_id.split('_')[0] if shard else None
+            if key not in shards:
+                shards[key] = _Shard(stem + '.' + key + suffix if shard else output)
+            out = shards[key]
+
+            bm = out.entity(iri_of(bm_id), bm_cls, name, shared=False)
+            lines = []
+            for item in dict.fromkeys(bm_usage.split('|')):
+                lines.append((bm, RDF_TYPE, iri_of(item)))
+            lines.append((bm, indicator_of, out.entity(iri_of(disease_id), disease_cls, disease_labels[disease_id])))
+            lines.append((bm, measured_in, out.entity(iri_of(source_id), source_cls, source_labels[source_id])))
+            for item in dict.fromkeys(str(assay).split('|')):
+                lines.append((bm, measured_by, out.entity(iri_of(item), assay_cls)))
+            for prop, value in zip(data_props, row[7:]):
+                if not pd.isnull(value): lines.append((bm, prop, literal(value)))
+            if not pd.isnull(pmid):
+                for item in dict.fromkeys(str(pmid).split('|')):
+                    lines.append((bm, has_evidence, out.entity(iri_of(item), publication_cls)))
+            out.out.write(''.join('{} {} {} .\n'.format(*line) for line in lines))
+    finally:
+        for out in shards.values():
+            out.out.close()
+    return [out.file for out in shards.values()]
@@ -0,0 +1,32 @@
+import os
+
+'''
+Locations of the files of the harmonization pipeline
+Kept apart from the pipeline so the command line can resolve them without importing pandas or owlready2
+'''
+
+SOURCES = ('upbd', 'oncomx', 'cbd')
+
+class Paths:
+    '''
+    Files of the pipeline: the extracted sources, merged table, manifest and run report in data_dir
+    (default: the directory of this file) and the ontology model and knowledge graph in model_dir
+    (default: BM_MODEL_DIR, else D:/ontoforce/model)
+    '''
+    def __init__(self, data_dir=None, model_dir=None, upbd_file=None):
+        self.data_dir = data_dir or os.path.dirname(os.path.abspath(__file__))
+        self.model_dir = model_dir or os.environ.get('BM_MODEL_DIR') or 'D:/ontoforce/model'
+        self.upbd_file = upbd_file or os.path.join(self.data_dir, 'upbd.xls')
+        self.manifest = os.path.join(self.data_dir, 'manifest.json')
+        self.merged = os.path.join(self.data_dir, 'merged.parquet')
+        self.report = os.environ.get('BM_REPORT') or os.path.join(self.data_dir, 'run_report.json')
+        self.model = os.path.join(self.model_dir, 'bm_model.owl')
+        self.store = os.path.join(self.model_dir, 'bm_db.sqlite3')
+        self.rdfxml = os.path.join(self.model_dir, 'bm_db.owl')
+        self.ntriples = os.path.join(self.model_dir, 'bm_db.nt.gz')
+
+    def source(self, name):
+        '''
+        Returns the Parquet file the source is extracted to (e.g. bm_upbd.parquet)
+        '''
+        return os.path.join(self.data_dir, 'bm_'+name+'.parquet')
@@ -0,0 +1,138 @@
+from collections import OrderedDict, namedtuple
+from owlready2 import label, rdf_type
+
+'''
+Query API over the biomarker knowledge graph
+Inverted indexes (disease, source, usage, publication -> biomarkers) are built from the quadstore in a few
+SQL scans and answer the common questions without SPARQL; free-form SPARQL results are kept in an LRU cache
+Both are rebuilt when the store changes
+'''
+
+Biomarker = namedtuple('Biomarker', ['id', 'name', 'usages', 'diseases', 'sources', 'assays', 'pmids', 'evidence_levels', 'molecular_ids'])
+
+class BiomarkerIndex:
+    '''
+    Input: the owlready2 world and biomarker ontology, e.g. from kg_builder.open_kg(store_file, read_only=True)
+    Entities are given by name (the part of the IRI after the base IRI, e.g. 'UBERON_0001088' or
+    'http://purl.obolibrary.org/obo/DOID_1612') or, for diseases and sources, by label (e.g. 'Urine')
+    '''
+    def __init__(self, world, biomarker, cache_size=128):
+        self.world = world
+        self.biomarker = biomarker
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._version = None
+        self._graph = None
+        self._refresh()
+
+    def find(self, disease=None, usage=None, source=None, pmid=None, evidence_level=None, molecular_id=None):
+        '''
+        Returns the biomarkers matching all given criteria, sorted by Id
+        disease, usage (e.g. 'DiagnosticBM'), source and pmid can be a single value or a list of alternatives
+        molecular_id matches biomarkers whose molecular ID contains it (e.g. 'BRCA1' matches 'BRCA1|BRCA2')
+        '''
+        self._refresh()
+        ids = None
+        for index, values in [(self.by_disease, disease), (self.by_usage, usage), (self.by_source, source), (self.by_pmid, pmid)]:
+            if values is None:
+                continue
+            values = [values] if isinstance(values, str) else values
+            matches = set()
+            for value in values:
+                value = str(value)
+                matches |= index.get(self._labels_to_names.get(value, value), set())
+            ids = matches if ids is None else ids & matches
+        records = (self.records[bm_id] for bm_id in (self.records if ids is None else ids))
+        if evidence_level is not None:
+            records = (bm for bm in records if evidence_level in bm.evidence_levels)
+        if molecular_id is not None:
+            records = (bm for bm in records if any(molecular_id in mid for mid in bm.molecular_ids))
+        return sorted(records, key=lambda bm: bm.id)
+
+    def get(self, bm_id):
+        '''
+        Returns the Biomarker with the given Id (e.g. 'oncomx_4f1c2b9a0d3e5f67'), or None
+        '''
+        self._refresh()
+        return self.records.get(bm_id)
+
+    def sparql(self, query):
+        '''
+        Runs a SPARQL query through rdflib, as in SPARQL_queries.ipynb, and returns the result rows as a list
+        Results are cached by the query text with normalized whitespace
+        '''
+        self._refresh()
+        key = ' '.join(query.split())
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        if self._graph is None:
+            self._graph = self.world.as_rdflib_graph()
+        result = [tuple(row) for row in self._graph.query(query)]
+        self._cache[key] = result
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return result
+
+    def _store_version(self):
+        # data_version changes on commits by other connections, total_changes on changes by this one
+        db = self.world.graph.db
+        return db.execute('PRAGMA data_version').fetchone()[0], db.total_changes
+
+    def _refresh(self):
+        version = self._store_version()
+        if version != self._version:
+            self._cache.clear()
+            self._build()
+            self._version = self._store_version()
+
+    def _build(self):
+        onto = self.biomarker
+        db = self.world.graph.db
+        base = onto.base_iri
+        names = {}
+        def name(storid):
+            if storid not in names:
+                iri = self.world._unabbreviate(storid)
+                names[storid] = iri[len(base):] if iri.startswith(base) else iri
+            return names[storid]
+        def objs(prop):
+            return db.execute('SELECT s, o FROM objs WHERE c=? AND p=?', (onto.graph.c, prop)).fetchall()
+        def datas(prop):
+            return db.execute('SELECT s, o FROM datas WHERE c=? AND p=?', (onto.graph.c, prop)).fetchall()
+
+        bm_ids = {s for s, o in objs(rdf_type) if o == onto.MolecularBM.storid}
+        usage_ids = {cls.storid for cls in onto.BiomarkerUsage.descendants()}
+        relations = {field: {} for field in ['usages', 'diseases', 'sources', 'assays', 'pmids']}
+        for field, prop, objects in [
+            ('usages', rdf_type, usage_ids), ('diseases', onto.indicatorOf.storid, None), ('sources', onto.measuredIn.storid, None),
+            ('assays', onto.measuredBy.storid, None), ('pmids', onto.hasEvidence.storid, None)]:
+            for s, o in objs(prop):
+                if s in bm_ids and (objects is None or o in objects):
+                    relations[field].setdefault(s, []).append(name(o))
+        values = {field: {} for field in ['name', 'evidence_levels', 'molecular_ids']}
+        labels = {}
+        for s, o in datas(label.storid):
+            if s in bm_ids:
+                values['name'][s] = o
+            else:
+                labels[s] = o
+        for field, prop in [('evidence_levels', onto.hasEvidenceLevel.storid), ('molecular_ids', onto.hasMolecularID.storid)]:
+            for s, o in datas(prop):
+                if s in bm_ids:
+                    values[field].setdefault(s, []).append(o)
+
+        self.records = {}
+        for s in bm_ids:
+            bm = Biomarker(name(s), values['name'].get(s),
+                *[tuple(relations[field].get(s, ())) for field in ['usages', 'diseases', 'sources', 'assays', 'pmids']],
+                *[tuple(values[field].get(s, ())) for field in ['evidence_levels', 'molecular_ids']])
+            self.records[bm.id] = bm
+        self._labels_to_names = {o: name(s) for s, o in labels.items()}
+
+        # Inverted indexes
+        self.by_disease, self.by_source, self.by_usage, self.by_pmid = {}, {}, {}, {}
+        for bm in self.records.values():
+            for index, keys in [(self.by_disease, bm.diseases), (self.by_source, bm.sources), (self.by_usage, bm.usages), (self.by_pmid, bm.pmids)]:
+                for key in keys:
+                    index.setdefault(key, set()).add(bm.id)
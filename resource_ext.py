@@ -1,11 +1,84 @@
 
+import os
+import re
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import pandas as pd
 import numpy as np
+from columnar import TableWriter, export_formats, export_table, read_table, write_table
+from disease_ids import resolve_disease_ids
+from fetch import Fetcher
+from instrument import iterate, log, stage
 
 '''
 Containing functions to be used for extracting biomarker information from different resources
 '''
 
+# Remote input files
+ONCOMX_BASE_URL = "http://data.oncomx.org/ln2wwwdata/reviewed/human_cancer_biomarkers_FDA_"
+CANCER_TYPES = ["breast","colorectal","lung","ovarian","prostate","melanoma"]
+ONCOMX_URLS = [ONCOMX_BASE_URL+cn_type+".csv" for cn_type in CANCER_TYPES]
+CBD_URL = "http://sysbio.suda.edu.cn/CBD/download/data.xlsx"
+
+# Source synonyms and their normalized names in the biomarker model
+SOURCES = {
+    ("Fresh Tissue","Paraffin block","Paraffin Block","Parrafin block","paraffin block","parrafin block", "tissue"):"Tissue",
+    ("Cell line","cell line"):"Tissue",
+    ("urine",):"Urine", 
+    ("blood",):"Blood",
+    ("saliva",):"Saliva",
+    ("human stool","Stool","stool","feces"):"Feces"
+}
+
+# namespace: http://purl.obolibrary.org/obo/
+SOURCE_IDS = {
+    "Tissue":"UBERON_0000479",
+    "Urine":"UBERON_0001088", 
+    "Blood":"UBERON_0000178",
+    "Saliva":"UBERON_0001836",
+    "Feces":"UBERON_0001988"
+}
+
+def _compile_lookup(vocabulary):
+    '''
+    Input: a dictionary mapping strings (or tuples of strings) to their replacement
+    Builds a single regex alternation over all keys, longest first, and a flat lookup table
+    Returns (compiled pattern, lookup dictionary)
+    '''
+    lookup = {}
+    for keys, value in vocabulary.items():
+        for key in (keys if isinstance(keys, tuple) else (keys,)):
+            lookup.setdefault(key, value)
+    pattern = re.compile('|'.join(re.escape(key) for key in sorted(lookup, key=len, reverse=True)))
+    return pattern, lookup
+
+_SOURCE_PATTERN, _SOURCE_LOOKUP = _compile_lookup(SOURCES)
+_SOURCE_ID_PATTERN, _SOURCE_ID_LOOKUP = _compile_lookup(SOURCE_IDS)
+
+def _map_unique(series, func):
+    '''
+    Input: a pandas.Series and a function taking a single (non-missing) value
+    Applies func once per distinct value and broadcasts the results back to all rows
+    Missing values are kept as they are
+    Returns a new pandas.Series with the same index
+    '''
+    codes, uniques = pd.factorize(series)
+    mapped = np.array([func(val) for val in uniques] + [np.nan], dtype=object)
+    return pd.Series(mapped[codes], index=series.index, name=series.name)
+
+def _norm_source(val, del_duplicate):
+    if not isinstance(val, str):
+        return val
+    val = _SOURCE_PATTERN.sub(lambda m: _SOURCE_LOOKUP[m.group(0)], val)
+    if del_duplicate:
+        val = '_'.join(dict.fromkeys(val.split(", ")))
+    return val
+
+def _source_id(val):
+    if not isinstance(val, str):
+        return val
+    return _SOURCE_ID_PATTERN.sub(lambda m: _SOURCE_ID_LOOKUP[m.group(0)], val)
+
 def adj_src(df,del_duplicate):
     '''
     Input: a pandas.DataFrame object containing 'Source' column  
@@ -13,286 +86,491 @@ def adj_src(df,del_duplicate):
     Add a column Source ID containing UBERON URIs
     Returns the processed DataFrame
     '''
-    sources = {
-        ("Fresh Tissue","Paraffin block","Paraffin Block","Parrafin block","paraffin block","parrafin block", "tissue"):"Tissue",
-        ("Cell line","cell line"):"Tissue",
-        ("urine"):"Urine", 
-        ("blood"):"Blood",
-        ("saliva"):"Saliva",
-        ("human stool","Stool","stool","feces"):"Feces"
-    }
-    
-    # namespace: http://purl.obolibrary.org/obo/
-    source_ids = {
-        "Tissue":"UBERON_0000479",
-        "Urine":"UBERON_0001088", 
-        "Blood":"UBERON_0000178",
-        "Saliva":"UBERON_0001836",
-        "Feces":"UBERON_0001988"
-    }
-
-    for key, value in sources.items():
-        df["Source"] = df["Source"].replace(to_replace = key, value = value,regex=True)
-
-    if del_duplicate:
-        # Remove duplicate values for source
-        for index, row in df.iterrows():
-            src = row['Source'].split(", ")
-            unique_src = list(dict.fromkeys(src))
-            df.at[index,'Source'] = '_'.join(unique_src)
-
-    df["Source ID"] = df["Source"]
-    for key, value in source_ids.items():
-        df["Source ID"] = df["Source ID"].replace(to_replace = key, value = value,regex=True)
+    # Sources repeat heavily, so every distinct value is normalized once and mapped back to the rows
+    df["Source"] = _map_unique(df["Source"], lambda val: _norm_source(val, del_duplicate))
+    df["Source ID"] = _map_unique(df["Source"], _source_id)
     
     return df
 
+# Usage synonyms and their (DISQOVER label, ontology class) in the biomarker model
+USAGES = {
+    ('Prognosis','prognostic_','prognostic','prognosis'):('Prognosis','PrognosticBM'),
+    ('Indicator of severity','Staging','Diease progression'):('Prognosis','PrognosticBM'),
+    ('diagnostic_','diagnostic','Diagnosis'):('Diagnosis','DiagnosticBM'),
+    ('Early diagnosis','Indicator of physiological process','Classification'):('Diagnosis','DiagnosticBM'),
+    ('predictive','Treatment','Prediction of response to treament'):('Prediction of response','PredictiveBM'),
+    ('predisposition','Risk factor'):('Susceptibility/Risk evaluation','RiskBM')
+}
+
+# token -> label lookup tables, one to be used in DISQOVER and one in the ontology graph
+_USAGE_DISQ = {token: labels[0] for tokens, labels in USAGES.items() for token in tokens}
+_USAGE_CLASS = {token: labels[1] for tokens, labels in USAGES.items() for token in tokens}
+_USAGE_SEP = re.compile(r'\s*[|,]\s*')
+
+def _norm_usage(val, lookup, unmapped):
+    if not isinstance(val, str):
+        return val
+    tokens = [token for token in _USAGE_SEP.split(val.strip()) if token]
+    unmapped.update(token for token in tokens if token not in lookup)
+    return '|'.join(lookup.get(token, token) for token in tokens)
+
 def adj_usage(df,disq):
     '''
     Input: a pandas.DataFrame object containing 'Usage' column  
-    Adjust usage to fit the biomarker model
+    Adjust usage to fit the biomarker model, multiple values are separated by '|'
+    Tokens missing from the vocabulary are kept as they are, the rows carrying them are counted per token
+    in df.attrs['Unmapped usage']
     Returns the processed DataFrame
     '''
-    # to be used in DISQOVER
-    usage_disq = {
-        ('Prognosis','prognostic_','prognostic','prognosis'):'Prognosis',
-        ('Indicator of severity','Staging','Diease progression'):'Prognosis',
-        ('diagnostic_','diagnostic','Diagnosis'):'Diagnosis',
-        ('Early diagnosis','Indicator of physiological process','Classification'):'Diagnosis',
-        ('predictive','Treatment','Prediction of response to treament'):'Prediction of response',
-        ('predisposition','Risk factor'):'Susceptibility/Risk evaluation'
-        }
-    
-    # to be used in ontology graph
-    usage = {
-        ('Prognosis','prognostic_','prognostic','prognosis'):'PrognosticBM',
-        ('Indicator of severity','Staging','Diease progression'):'PrognosticBM',
-        ('diagnostic_','diagnostic','Diagnosis'):'DiagnosticBM',
-        ('Early diagnosis','Indicator of physiological process','Classification'):'DiagnosticBM',
-        ('predictive','Treatment','Prediction of response to treament'):'PredictiveBM',
-        ('predisposition','Risk factor'):'RiskBM'
-        }
-    
-    if disq: 
-        for keys, values in usage_disq.items():
-            df["Usage"] = df["Usage"].replace(to_replace = keys, value = values,regex=True)
-    else: 
-        for keys, values in usage.items():
-            df["Usage"] = df["Usage"].replace(to_replace = keys, value = values,regex=True)
+    lookup = _USAGE_DISQ if disq else _USAGE_CLASS
+    # Every distinct value is normalized once, its unmapped tokens count for all the rows having that value
+    codes, uniques = pd.factorize(df["Usage"])
+    rows = np.bincount(codes[codes >= 0], minlength=len(uniques))
+    normalized = []
+    counts = {}
+    unmapped_rows = 0
+    for val, n in zip(uniques, rows):
+        unmapped = set()
+        normalized.append(_norm_usage(val, lookup, unmapped))
+        for token in unmapped:
+            counts[token] = counts.get(token, 0) + int(n)
+        if unmapped:
+            unmapped_rows += int(n)
+    mapped = np.array(normalized + [np.nan], dtype=object)
+    df["Usage"] = pd.Series(mapped[codes], index=df.index, name="Usage")
+
+    # Keep track of vocabulary drift
+    if counts:
+        log("Found {} unmapped usage values in {} rows: {}".format(len(counts), unmapped_rows, counts))
+    df.attrs['Unmapped usage'] = counts
     
     return df
 
-# Seperate multiple values by '|'
-def adj_mult(val,sep):
-    if val is np.NaN:
-        return val
-    else:
-        val_list = [x.strip() for x in str(val).split(sep)]
-        new_val = "|".join(val_list)
-        return new_val
+def adj_mult(col,sep):
+    '''
+    Input: a pandas.Series and a separator or a tuple of separators (None splits on whitespace)
+    Seperate multiple values by '|', stripping whitespace around every value
+    Separators are applied in the given order, missing values are kept as they are
+    Returns the processed pandas.Series
+    '''
+    seps = sep if isinstance(sep, tuple) else (sep,)
+    notna = col.notna()
+    vals = col[notna].astype(str).str.strip()
+    for sep in seps:
+        pattern = r'\s+' if sep is None else r'\s*' + re.escape(sep) + r'\s*'
+        vals = vals.str.replace(pattern, '|', regex=True)
+    new_col = col.astype(object)
+    new_col[notna] = vals
+    return new_col
     
-def extract_upbd(input_file,output_file,disqover):
-    """
-    Read local csv file (input_file) downloaded from Urine Protein Biomarker Database 
-    http://upbd.bmicc.cn/biomarker/web/indexdb
-    Extract and adjust relevant information to fit the Biomarker model 
-    Writes results to output_file (csv) and returns a DataFrame
-    """
-    print("\nExtracting Urine Protein Biomarker Database...")
-    upbd = pd.read_excel(input_file,sheet_name='Page 1', index_col=None, na_values=['NA'])
+# Low-cardinality columns of the harmonized table, stored as categoricals
+# Categories start from the model vocabulary, values outside of it are added when they occur
+CATEGORIES = {
+    'Source': list(SOURCE_IDS),
+    'Source ID': list(SOURCE_IDS.values()),
+    'Type': ['Molecular Biomarker'],
+    'Molecular type': [],
+    'Usage': [],
+    'In a panel': ['No','Yes'],
+    'Disease': [],
+    'Disease ID': [],
+}
 
-    # Extracting relevant information
-    # The dataset does not contain information about evidence level
-    subset = upbd[['Protein name','Protein ID','Biomarker usage','Treatment','Disease','Disease ID','In a panel','Experiment','Pmid']]
-    
-    # Ajust Disease URIs to fit DISQOVER
-    if disqover:
-        #  http://purl.bioontology.org/ontology/ICD10CM/C67 -> http://ns.ontoforce.com/datasets/icd10/C67
-        # http://ncicb.nci.nih.gov/xml/owl/EVS/Thesaurus.owl#C114841 -> http://ns.ontoforce.com/datasets/nci/C114841
-        def adj_dis_id(val):
-            new_id = val
-            if val.startswith('http://purl.bioontology.org/'):
-                var_list = val.split('/')
-                new_id = 'http://ns.ontoforce.com/datasets/'+var_list[-2][:-2].lower()+'/'+var_list[-1]
-            if val.startswith('http://ncicb.nci.nih.gov/xml/owl/EVS/Thesaurus.owl'):
-                var_list = val.split('#')
-                new_id = 'http://ns.ontoforce.com/datasets/nci/'+var_list[-1]
-            return new_id
-
-        subset["Disease ID"] = subset.apply(lambda x:adj_dis_id(x["Disease ID"]), axis = 1)
+def to_categorical(df,disq):
+    '''
+    Input: a pandas.DataFrame with (some of) the columns in CATEGORIES
+    Converts these columns to categorical dtypes, usage categories are the DISQOVER labels if disq
+    or the ontology classes otherwise
+    Returns the processed DataFrame
+    '''
+    for col, categories in CATEGORIES.items():
+        if col not in df:
+            continue
+        if col == 'Usage':
+            categories = list(dict.fromkeys(labels[0 if disq else 1] for labels in USAGES.values()))
+        known = set(categories)
+        extra = sorted({str(val) for val in df[col].dropna().unique()} - known)
+        df[col] = pd.Categorical(df[col].where(df[col].isna(), df[col].astype(str)), categories=categories+extra)
+    return df
+
+def concat_biomarkers(dfs):
+    '''
+    Input: a list of pandas.DataFrame objects returned by the extractors
+    Concatenates them, keeping the categorical columns categorical by aligning their categories first
+    Returns the merged DataFrame
+    '''
+    dfs = [df.copy() for df in dfs]
+    for col in CATEGORIES:
+        frames = [df for df in dfs if col in df and isinstance(df[col].dtype, pd.CategoricalDtype)]
+        categories = list(dict.fromkeys(cat for df in frames for cat in df[col].cat.categories))
+        for df in frames:
+            df[col] = df[col].cat.set_categories(categories)
+    return pd.concat(dfs)
+
+def collapse_panels(df,keys):
+    '''
+    Input: a pandas.DataFrame object of panel participants, one row per component, and the columns identifying a panel
+    Collapses every panel into one biomarker, taking the first participant's row
+    'Name' joins the participant names by ',' and 'Molecular ID' joins their IDs by '|'
+    'Components' lists the participant names separated by '|', to link a ComplexBM to its components (hasComponent)
+    Rows with missing values in keys are dropped, panels are returned in sorted key order
+    Returns the collapsed DataFrame
+    '''
+    # Rows with a missing key get no group number (NaN or -1 depending on the pandas version)
+    group_ids = df.groupby(keys).ngroup().fillna(-1).to_numpy(dtype=int)
+    df = df[group_ids >= 0]
+    group_ids = group_ids[group_ids >= 0]
+
+    # Stable sort keeps the participant order within every panel
+    order = np.argsort(group_ids, kind='stable')
+    df = df.iloc[order]
+    group_ids = group_ids[order]
+
+    joined = df.groupby(group_ids, sort=True).agg(
+        Name=('Name', ','.join), MolecularIDs=('Molecular ID', '|'.join), Components=('Name', '|'.join))
+    first_rows = np.r_[True, group_ids[1:] != group_ids[:-1]] if len(group_ids) else np.zeros(0, dtype=bool)
+    panels = df[first_rows].copy()
+    panels['Name'] = joined['Name'].to_numpy()
+    panels['Molecular ID'] = joined['MolecularIDs'].to_numpy()
+    panels['Components'] = joined['Components'].to_numpy()
+    return panels
+
+def stable_ids(df, keys, seen=None):
+    '''
+    Input: a pandas.DataFrame and the columns identifying a biomarker within its source (its natural key)
+    Derives every Id from a hash of the key values, so rows keep their Id when other rows are added, changed
+    or removed; integral numbers give the same Id whether they are read as integers or floats
+    Rows sharing a key are numbered in their order ('<hash>', '<hash>-2', ...), seen carries the counts over chunks
+    Returns a pandas.Series of Ids
+    '''
+    values = df[keys].astype(str).apply(lambda col: col.str.replace(r'\.0$', '', regex=True))
+    hashes = pd.util.hash_pandas_object(values, index=False)
+    seen = {} if seen is None else seen
+    ids = []
+    for h in hashes:
+        key = '{:016x}'.format(h)
+        seen[key] = seen.get(key, 0) + 1
+        ids.append(key if seen[key] == 1 else key+'-'+str(seen[key]))
+    return pd.Series(ids, index=df.index, dtype=object)
+
+# Natural keys of the sources, descriptive columns are left out so changing them updates the biomarker in place
+UPBD_KEYS = ['Name','Molecular ID','Disease ID','Usage','Assay/Test','Pmid','Treatment','In a panel']
+ONCOMX_KEYS = ['Name','Disease ID','Usage','Source','Assay/Test','Test manufacturer','Pmid','Treatment','Clinical trail ID']
+CBD_KEYS = ['Name','Source','Assay/Test','Usage','Pmid']
+
+UPBD_COLUMNS = ['Protein name','Protein ID','Biomarker usage','Treatment','Disease','Disease ID','In a panel','Experiment','Pmid']
+
+def _read_upbd_chunks(input_file, chunksize):
+    '''
+    Reads the UPBD columns of sheet 'Page 1' in DataFrames of at most chunksize rows
+    xlsx files are streamed row by row, other formats (e.g. xls) are loaded once and then split
+    '''
+    from openpyxl import load_workbook
+    from openpyxl.utils.exceptions import InvalidFileException
+    try:
+        workbook = load_workbook(input_file, read_only=True, data_only=True)
+    except (InvalidFileException, KeyError, OSError, ValueError):
+        upbd = pd.read_excel(input_file,sheet_name='Page 1', index_col=None, na_values=['NA'], usecols=UPBD_COLUMNS)
+        for start in range(0, len(upbd), chunksize):
+            yield upbd.iloc[start:start+chunksize]
+        return
+    try:
+        rows = workbook['Page 1'].iter_rows(values_only=True)
+        header = list(next(rows))
+        positions = [header.index(col) for col in UPBD_COLUMNS]
+        chunk = []
+        for row in rows:
+            chunk.append([row[i] if i < len(row) else None for i in positions])
+            if len(chunk) == chunksize:
+                yield pd.DataFrame(chunk, columns=UPBD_COLUMNS, dtype=object).replace({'NA': np.nan, None: np.nan})
+                chunk = []
+        if chunk:
+            yield pd.DataFrame(chunk, columns=UPBD_COLUMNS, dtype=object).replace({'NA': np.nan, None: np.nan})
+    finally:
+        workbook.close()
+
+def _normalize_upbd(subset, disqover):
+    '''
+    Adjusts UPBD rows (the columns in UPBD_COLUMNS) to fit the Biomarker model
+    Returns the processed DataFrame, before removing incomplete and duplicate rows
+    '''
+    subset = subset[UPBD_COLUMNS].copy()
+
+    # PMIDs are read as floats when some are missing (but as integers from streamed chunks), both give the same strings
+    pmid = subset['Pmid']
+    subset['Pmid'] = pmid.where(pmid.isna(), pmid.astype(str).str.replace(r'\.0$', '', regex=True))
+
+    # Ajust Disease URIs (to fit DISQOVER if disqover)
+    subset["Disease ID"] = resolve_disease_ids(subset["Disease ID"], disqover)
 
     # Renaming columns to fit the biomarker model terminology and adding relevant columns
     subset.rename(columns={'Protein name':'Name','Protein ID':'Molecular ID','Biomarker usage':'Usage','Experiment':'Assay/Test'}, inplace=True)
     subset['Source'] = 'Urine'
     subset['Type'] = 'Molecular Biomarker'
     subset['Molecular type'] = 'Protein'
-    subset['Evidence level'] = np.NaN
+    subset['Evidence level'] = np.nan
 
     # Converting usage to fit the biomarker model and add source id
     subset = adj_usage(subset, disqover)
     subset = adj_src(subset, False)
+    return subset
 
-    # Remove biomarkers with no inforamtion about assay, usage or whether it's a singel or a panel
-    nrow_before = subset.shape[0]
-    subset = subset.dropna(subset = ['Assay/Test', 'Usage','In a panel'])
-    subset.drop_duplicates(inplace=True) 
-    nrow_after = subset.shape[0]
-    dropped = nrow_before-nrow_after
-    dropped_per = round(dropped/nrow_before*100,2)
-    print("Dropped {} ({}%) duplicate rows or rows with missing data over assay, usage or panel".format(dropped, dropped_per))
-    
-    subset['In a panel'] = subset['In a panel'].replace({'FALSE':'No', 'TRUE':'Yes',False:'No', True:'Yes'})
-    subset['Id'] = subset.reset_index().index+1
+def extract_upbd(input_file,output_file,disqover,fetcher=None,chunksize=None):
+    """
+    Read local csv file (input_file) downloaded from Urine Protein Biomarker Database 
+    http://upbd.bmicc.cn/biomarker/web/indexdb
+    Extract and adjust relevant information to fit the Biomarker model 
+    input_file may also be a URL, read through fetcher (a fetch.Fetcher, created from the environment if None)
+    With chunksize, the file is read and processed in chunks of that many rows and the results are appended
+    to output_file as they go, so memory is bounded by the chunk size; Ids are the same as when loading it at once
+    Writes results to output_file (Parquet, all values as strings) and returns a DataFrame,
+    or with chunksize the number of written rows, as the table is not loaded back
+    BM_EXPORTS=1 also exports them as csv (see columnar), streamed chunk by chunk with chunksize
+    """
+    with stage('upbd') as upbd:
+        log("\nExtracting Urine Protein Biomarker Database...")
+        fetcher = fetcher or Fetcher()
+        input_file = fetcher.fetch(input_file)
+        if chunksize:
+            chunks = iterate('read', _read_upbd_chunks(input_file, chunksize))
+        else:
+            with stage('read') as read:
+                chunks = [pd.read_excel(input_file,sheet_name='Page 1', index_col=None, na_values=['NA'])]
+                read.rows(rows_out=len(chunks[0]))
 
-    # Write to csv file
-    new_index = [
-        'Id','Name','Usage','Disease','Disease ID','In a panel','Evidence level','Type','Source','Source ID',
-        'Assay/Test','Pmid','Molecular type','Molecular ID','Treatment']
-    
-    print("Writing to "+output_file)
-    subset.to_csv(output_file, columns = new_index, index = False)
-    return subset
+        # Write to Parquet file
+        new_index = [
+            'Id','Name','Usage','Disease','Disease ID','In a panel','Evidence level','Type','Source','Source ID',
+            'Assay/Test','Pmid','Molecular type','Molecular ID','Treatment']
 
-def extract_oncomx(output_file,disqover):
+        # Extracting relevant information
+        # The dataset does not contain information about evidence level
+        # Rows seen in earlier chunks are recognized by their fingerprint
+        fingerprints = set()
+        id_counts = {}
+        nrow_before = nrow_after = incomplete = 0
+        exports = export_formats(['csv'])
+        csv_file = os.path.splitext(output_file)[0] + '.csv'
+        stream_csv = bool(chunksize) and 'csv' in exports
+        log("Writing to "+output_file)
+        with TableWriter(output_file, new_index) as writer:
+            for subset in chunks:
+                upbd.rows(rows_in=len(subset))
+                with stage('normalize', rows_in=len(subset)) as normalize:
+                    subset = _normalize_upbd(subset, disqover)
+                    normalize.rows(rows_out=len(subset))
+
+                # Remove biomarkers with no inforamtion about assay, usage or whether it's a singel or a panel
+                with stage('dedupe', rows_in=len(subset)) as dedupe:
+                    nrow_before += subset.shape[0]
+                    nrow_read = subset.shape[0]
+                    subset = subset.dropna(subset = ['Assay/Test', 'Usage','In a panel'])
+                    incomplete += nrow_read - subset.shape[0]
+                    subset = subset[~subset.duplicated()]
+                    if chunksize:
+                        hashes = pd.util.hash_pandas_object(subset.astype(object), index=False)
+                        new_rows = ~hashes.isin(fingerprints).to_numpy()
+                        subset = subset[new_rows]
+                        fingerprints.update(hashes[new_rows])
+                    dedupe.rows(rows_out=len(subset))
+
+                with stage('write', rows_in=len(subset)):
+                    subset['In a panel'] = subset['In a panel'].replace({'FALSE':'No', 'TRUE':'Yes',False:'No', True:'Yes'})
+                    subset['Id'] = stable_ids(subset, UPBD_KEYS, id_counts)
+                    written = writer.write(subset)
+                    if stream_csv:
+                        written.to_csv(csv_file, mode='a' if nrow_after else 'w', header=not nrow_after, index=False)
+                    nrow_after += subset.shape[0]
+
+        upbd.drop(incomplete, nrow_before, "rows with missing data over assay, usage or panel")
+        upbd.drop(nrow_before-nrow_after-incomplete, nrow_before, "duplicate rows")
+        upbd.rows(rows_out=nrow_after)
+        if chunksize:
+            # Only exports that need the whole table (json, xlsx) load it back
+            exports = [fmt for fmt in exports if fmt != 'csv']
+            if exports:
+                with stage('export'):
+                    export_table(read_table(output_file), output_file, exports)
+            return nrow_after
+        # The table is returned as stored
+        subset = read_table(output_file)
+        with stage('export'):
+            export_table(subset, output_file, exports)
+    return to_categorical(subset, disqover)
+
+def extract_oncomx(output_file,disqover,fetcher=None,max_workers=None):
     '''
     Oncomx contains datasets of FDA-approved or cleared nucleic acid-based human biomarker tests for cancer
     Each row represents one gene linked to its respective test. 
     Genes are labeled by relevant identifiers/accessions from UniProtKB, HGNC, and EDRN. 
     Tests are distinguished by manufacturer, FDA submission ID(s), clinical trial ID(s), and PubMed ID(s).
-    Writes results to output_file (csv) and returns a DataFrame
+    Files are read through fetcher (a fetch.Fetcher, created from the environment if None),
+    max_workers of them concurrently (default: all cancer types at once)
+    Writes results to output_file (Parquet) and returns a DataFrame, BM_EXPORTS=1 also exports them as json and xlsx
     '''
     # Read and join csv's into one dataframe
-    print("\nExtracting data from Oncomex...")
-    base_url = "http://data.oncomx.org/ln2wwwdata/reviewed/human_cancer_biomarkers_FDA_"
-    cancer_types = ["breast","colorectal","lung","ovarian","prostate","melanoma"]
-    dfs = []
-    for cn_type in cancer_types:
-        url = base_url+cn_type+".csv"
-        print("Reading from: "+url)
-        dfs.append(pd.read_csv(url))
-        
-    joined_dfs = pd.concat(dfs,ignore_index=True)
-    
-    # Define relevant columns to extract
-    cols = [
-        "gene_symbol","test_is_a_panel","do_name","doid","actual_use","test_adoption_evidence",
-        "specimen_type","test_trade_name","test_manufacturer","pmid",
-        "biomarker_drug","biomarker_description","biomarker_origin","test_trial_id",
-        ]
-    subset = joined_dfs[cols]
-
-    # Renaming, adding relevant columns, adjusting usage and source
-    subset.rename(columns={
-        'gene_symbol':'Name','test_is_a_panel':'In a panel','do_name':'Disease','doid':'Disease ID',
-        'actual_use':'Usage','specimen_type':'Source','test_trade_name':'Assay/Test',
-        'test_manufacturer':'Test manufacturer','pmid':'Pmid','test_adoption_evidence':'Evidence level',
-        'biomarker_drug':'Treatment','biomarker_description':'Description','biomarker_origin':'Molecular type','test_trial_id':'Clinical trail ID'
-        }, inplace=True)
-    
-    # namespace: http://identifiers.org/hgnc.symbol/
-    subset["Molecular ID"] = subset["Name"].str.upper()
-    
-    subset["Type"] = 'Molecular Biomarker'
-    subset["Disease ID"] = "http://purl.obolibrary.org/obo/DOID_" + subset["Disease ID"].astype(str)
-    
-    subset = adj_src(subset, False)
+    with stage('oncomx') as oncomx:
+        log("\nExtracting data from Oncomex...")
+        fetcher = fetcher or Fetcher()
 
-    # Adjust multiple values to be seperated by "|"
-    subset.loc[subset["Clinical trail ID"] == "-","Clinical trail ID"] = np.NaN
-    subset["Clinical trail ID"] = subset.apply(lambda x:adj_mult(x["Clinical trail ID"],"_"), axis = 1)
-    subset["Clinical trail ID"] = subset.apply(lambda x:adj_mult(x["Clinical trail ID"],"/"), axis = 1)
-    subset["Assay/Test"] = subset.apply(lambda x:adj_mult(x["Assay/Test"],"_ "), axis = 1)
-    subset["Usage"] = subset.apply(lambda x:adj_mult(x["Usage"],None), axis = 1)
-    subset = adj_usage(subset, disqover)
-    subset["Pmid"] = subset.apply(lambda x:adj_mult(x["Pmid"],"_"), axis = 1)
-    subset["Pmid"] = subset.apply(lambda x:adj_mult(x["Pmid"],None), axis = 1)
-
-    # group panel participants into one biomarker with references to its participants
-    panel_groups = subset[subset['In a panel']=='Y'].groupby(['Pmid','Disease','Description','Usage','Molecular type','Assay/Test'])
-    singledf = subset[subset['In a panel']=='N']
-
-    for name, group in panel_groups:
-        first_row = True
-        for index,row in group.iterrows():
-            if first_row: 
-                name = row['Name']
-                molecular_ids = row['Molecular ID']
-                panel = row
-                first_row = False
-            else: 
-                name = name + ',' + row['Name']
-                molecular_ids = molecular_ids + '|' + row['Molecular ID']
-        panel['Name'] = name
-        panel['Molecular ID'] = molecular_ids
-        singledf = singledf.append(panel)
-
-    singledf['Id'] = singledf.reset_index().index+1
-    singledf['In a panel'] = 'No'
-
-    # Write to csv file
-    new_index = [
-        'Id','Name','Usage','Disease','Disease ID','In a panel','Evidence level','Type','Source','Source ID',
-        'Assay/Test','Test manufacturer','Pmid','Molecular type','Molecular ID','Treatment','Description','Clinical trail ID']
-    
-    print("Writing to "+output_file)
-    singledf.to_excel('onc.xlsx', columns = new_index, index = False)
-    singledf.to_json(output_file,orient='records')
-    return singledf
+        def read(url):
+            log("Reading from: "+url)
+            return pd.read_csv(fetcher.fetch(url))
+
+        # map() keeps the order of the cancer types whatever order the downloads finish in
+        with stage('read') as reading:
+            with ThreadPoolExecutor(max_workers=max_workers or len(ONCOMX_URLS)) as pool:
+                dfs = list(pool.map(read, ONCOMX_URLS))
+            joined_dfs = pd.concat(dfs,ignore_index=True)
+            reading.rows(rows_out=len(joined_dfs))
+        oncomx.rows(rows_in=len(joined_dfs))
+
+        with stage('normalize', rows_in=len(joined_dfs)) as normalize:
+            # Define relevant columns to extract
+            cols = [
+                "gene_symbol","test_is_a_panel","do_name","doid","actual_use","test_adoption_evidence",
+                "specimen_type","test_trade_name","test_manufacturer","pmid",
+                "biomarker_drug","biomarker_description","biomarker_origin","test_trial_id",
+                ]
+            subset = joined_dfs[cols]
 
-def extract_cbd(output_file, disqover):
+            # Renaming, adding relevant columns, adjusting usage and source
+            subset.rename(columns={
+                'gene_symbol':'Name','test_is_a_panel':'In a panel','do_name':'Disease','doid':'Disease ID',
+                'actual_use':'Usage','specimen_type':'Source','test_trade_name':'Assay/Test',
+                'test_manufacturer':'Test manufacturer','pmid':'Pmid','test_adoption_evidence':'Evidence level',
+                'biomarker_drug':'Treatment','biomarker_description':'Description','biomarker_origin':'Molecular type','test_trial_id':'Clinical trail ID'
+                }, inplace=True)
+
+            # namespace: http://identifiers.org/hgnc.symbol/
+            subset["Molecular ID"] = subset["Name"].str.upper()
+
+            subset["Type"] = 'Molecular Biomarker'
+            subset["Disease ID"] = resolve_disease_ids(subset["Disease ID"], disqover)
+
+            subset = adj_src(subset, False)
+
+            # Adjust multiple values to be seperated by "|"
+            subset.loc[subset["Clinical trail ID"] == "-","Clinical trail ID"] = np.nan
+            subset["Clinical trail ID"] = adj_mult(subset["Clinical trail ID"],("_","/"))
+            subset["Assay/Test"] = adj_mult(subset["Assay/Test"],"_ ")
+            subset["Usage"] = adj_mult(subset["Usage"],None)
+            subset = adj_usage(subset, disqover)
+            subset["Pmid"] = adj_mult(subset["Pmid"],("_",None))
+            normalize.rows(rows_out=len(subset))
+
+        # group panel participants into one biomarker with references to its participants
+        with stage('panels', rows_in=len(subset)) as panels_stage:
+            keys = ['Pmid','Disease','Description','Usage','Molecular type','Assay/Test']
+            singledf = subset[subset['In a panel']=='N']
+            members = subset[subset['In a panel']=='Y']
+            panels = collapse_panels(members,keys)
+            complete = int(members[keys].notna().all(axis=1).sum())
+            panels_stage.info.update({'panel members': complete, 'panels': len(panels)})
+            oncomx.drop(len(subset)-len(singledf)-len(members), len(subset), "rows with no panel information")
+            oncomx.drop(len(members)-complete, len(subset), "panel rows with missing data over the panel keys")
+            singledf = pd.concat([singledf, panels])
+            panels_stage.rows(rows_out=len(singledf))
+
+        singledf['Id'] = stable_ids(singledf, ONCOMX_KEYS)
+        # 'In a panel' tells whether a biomarker is a member of a panel (as in UPBD), collapsed panels are not;
+        # they are the rows with their participants listed in 'Components'
+        singledf['In a panel'] = 'No'
+
+        # Write to Parquet file
+        new_index = [
+            'Id','Name','Usage','Disease','Disease ID','In a panel','Evidence level','Type','Source','Source ID',
+            'Assay/Test','Test manufacturer','Pmid','Molecular type','Molecular ID','Treatment','Description','Clinical trail ID','Components']
+
+        with stage('write', rows_in=len(singledf)):
+            log("Writing to "+output_file)
+            write_table(singledf, output_file)
+        with stage('export'):
+            export_table(singledf, output_file, export_formats(['json', 'xlsx']), columns = new_index)
+        oncomx.rows(rows_out=len(singledf))
+    return to_categorical(singledf, disqover)
+
+def extract_cbd(output_file, disqover, fetcher=None):
     """
     CBD: Colorectal Cancer Biomarker Database http://sysbio.suda.edu.cn/CBD/index.html
     Missing information in DB: In a panel, Evidence level, Molecular ID (assinged NaN values)
-    Writes results to output_file (csv) and returns a DataFrame
+    The file is read through fetcher (a fetch.Fetcher, created from the environment if None)
+    Writes results to output_file (Parquet) and returns a DataFrame, BM_EXPORTS=1 also exports them as json
     """
-    print("\nExtracting data from Colorectal Cancer Biomarker Database...")
-    url = "http://sysbio.suda.edu.cn/CBD/download/data.xlsx"
-    cbd = pd.read_excel(url, index_col=None)
+    with stage('cbd') as cbd_stage:
+        log("\nExtracting data from Colorectal Cancer Biomarker Database...")
+        fetcher = fetcher or Fetcher()
+        with stage('read') as read:
+            cbd = pd.read_excel(fetcher.fetch(CBD_URL), index_col=None)
+            read.rows(rows_out=len(cbd))
+        cbd_stage.rows(rows_in=len(cbd))
 
-    
-    # Extract relevant information
-    subset = cbd[["Biomarker","Categary","Discription","Location","Source","Experiment","Application","PMID","Statictics","Conclusion"]]
-    subset.rename(columns={
-        'Biomarker':'Name','Application':'Usage','PMID':'Pmid','Categary':'Molecular type', 'Experiment':'Assay/Test'}, inplace=True)
-    
-    # Join all columns decscribing the experiment and its results and conclusions into one column
-    subset["Description"] = subset.apply(lambda x: ' '.join(x[["Discription","Statictics","Conclusion"]].dropna().astype(str).values), axis=1)
-    subset = subset.drop(["Discription","Statictics","Conclusion"],axis=1)
-
-    # Dropping rows with no data over Experiment (assay) or Source
-    nrow_before = subset.shape[0]
-    subset = subset.dropna(subset = ["Assay/Test","Source","Usage"])
-    nrow_after = subset.shape[0]
-    dropped = nrow_before-nrow_after
-    dropped_per = round(dropped/nrow_before*100,2)
-    print("Dropped {} ({}%) rows with missing data over assay, source or usage".format(dropped, dropped_per))
-    
-    subset.loc[subset["Molecular type"] == "Other","Molecular type"] = np.NaN
-    
-    subset['Disease'] = 'Colorectal Cancer'
-    subset['Disease ID'] = 'http://purl.obolibrary.org/obo/DOID_9256'
-    subset['Type'] = 'Molecular Biomarker'
-    subset['In a panel'] = np.NaN
-    subset['Evidence level'] = np.NaN
-    subset['Molecular ID'] = np.NaN
+        with stage('normalize', rows_in=len(cbd)) as normalize:
+            # Extract relevant information
+            subset = cbd[["Biomarker","Categary","Discription","Location","Source","Experiment","Application","PMID","Statictics","Conclusion"]]
+            subset.rename(columns={
+                'Biomarker':'Name','Application':'Usage','PMID':'Pmid','Categary':'Molecular type', 'Experiment':'Assay/Test'}, inplace=True)
 
-    subset = adj_usage(subset, disqover)
-    subset["Usage"] = subset.apply(lambda x:adj_mult(x["Usage"],","), axis = 1)
-
-    # Some rows have multiple values for source, which are mostly duplicates, therefore rem_duplicate = True
-    subset = adj_src(subset, True)
-    # Remove rows with more than once source 
-    nrow_before = subset.shape[0]
-    subset = subset.drop(subset[subset['Source'].str.contains('_')].index)
-    nrow_after = subset.shape[0]
-    dropped = nrow_before-nrow_after
-    dropped_per = round(dropped/nrow_before*100,2)
-    print("Dropped {} ({}%) rows with more than one source".format(dropped, dropped_per))
-
-    subset["Assay/Test"] = subset.apply(lambda x:adj_mult(x["Assay/Test"],","), axis = 1)
-    subset['Id'] = subset.reset_index().index+1
-    
-    print("Writing to "+output_file)
-    subset.to_json(output_file,orient='records')
+            # Join all columns decscribing the experiment and its results and conclusions into one column
+            subset["Description"] = subset.apply(lambda x: ' '.join(x[["Discription","Statictics","Conclusion"]].dropna().astype(str).values), axis=1)
+            subset = subset.drop(["Discription","Statictics","Conclusion"],axis=1)
+
+            # Dropping rows with no data over Experiment (assay) or Source
+            nrow_before = subset.shape[0]
+            subset = subset.dropna(subset = ["Assay/Test","Source","Usage"])
+            cbd_stage.drop(nrow_before-subset.shape[0], nrow_before, "rows with missing data over assay, source or usage")
+
+            subset.loc[subset["Molecular type"] == "Other","Molecular type"] = np.nan
+
+            subset['Disease'] = 'Colorectal Cancer'
+            subset['Disease ID'] = 'http://purl.obolibrary.org/obo/DOID_9256'
+            subset['Type'] = 'Molecular Biomarker'
+            subset['In a panel'] = np.nan
+            subset['Evidence level'] = np.nan
+            subset['Molecular ID'] = np.nan
+
+            subset = adj_usage(subset, disqover)
+            subset["Usage"] = adj_mult(subset["Usage"],",")
 
-    return subset
\ No newline at end of file
+            # Some rows have multiple values for source, which are mostly duplicates, therefore rem_duplicate = True
+            subset = adj_src(subset, True)
+            # Remove rows with more than once source
+            nrow_before = subset.shape[0]
+            subset = subset.drop(subset[subset['Source'].str.contains('_')].index)
+            cbd_stage.drop(nrow_before-subset.shape[0], nrow_before, "rows with more than one source")
+
+            subset["Assay/Test"] = adj_mult(subset["Assay/Test"],",")
+            subset['Id'] = stable_ids(subset, CBD_KEYS)
+            normalize.rows(rows_out=len(subset))
+
+        with stage('write', rows_in=len(subset)):
+            log("Writing to "+output_file)
+            write_table(subset, output_file)
+        with stage('export'):
+            export_table(subset, output_file, export_formats(['json']))
+        cbd_stage.rows(rows_out=len(subset))
+
+    return to_categorical(subset, disqover)
+
+def extract_sources(jobs, max_workers=None, processes=False):
+    '''
+    Input: a dictionary mapping source names to (extract function, args, kwargs)
+    Runs the extractors concurrently on a thread pool (or a process pool if processes is True)
+    of max_workers workers (default: BM_WORKERS environment variable, else one per source)
+    A failing extractor does not stop the others, its error is printed and its result is None
+    The extractors record their stages in the current run report (see instrument), except in worker processes
+    Returns a dictionary with the results of the extractors (e.g. DataFrames), in the order of jobs
+    '''
+    max_workers = max_workers or int(os.environ.get('BM_WORKERS', 0)) or max(len(jobs), 1)
+    executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    results = {}
+    with executor(max_workers=max_workers) as pool:
+        futures = {name: pool.submit(func, *args, **kwargs) for name, (func, args, kwargs) in jobs.items()}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception:
+                log("\nExtracting {} failed:".format(name))
+                traceback.print_exc()
+                results[name] = None
+    return results
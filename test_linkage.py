@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+from linkage import link_biomarkers
+
+'''
+Tests of the linkage of duplicate biomarkers, run with `python -m pytest`
+'''
+
+DOID_9256 = 'http://purl.obolibrary.org/obo/DOID_9256'
+
+def kras_rows():
+    # The prognostic KRAS / colorectal cancer / tissue association as extracted from OncoMX and from CBD
+    return pd.DataFrame([
+        {'Id': 'oncomx_11', 'Name': 'KRAS', 'Usage': 'PrognosticBM', 'Disease': 'colorectal cancer', 'Disease ID': DOID_9256,
+         'Source': 'Tissue', 'Source ID': 'UBERON_0000479', 'Assay/Test': 'Therascreen KRAS RGQ PCR Kit', 'Pmid': '28201998',
+         'Molecular type': 'somatic mutation', 'Molecular ID': 'KRAS'},
+        {'Id': 'cbd_20', 'Name': 'KRAS', 'Usage': 'PrognosticBM', 'Disease': 'Colorectal Cancer', 'Disease ID': DOID_9256,
+         'Source': 'Tissue', 'Source ID': 'UBERON_0000479', 'Assay/Test': 'qRT-PCR', 'Pmid': 9042267,
+         'Molecular type': 'Protein', 'Molecular ID': np.nan},
+    ])
+
+def test_links_across_sources():
+    linked = link_biomarkers(kras_rows())
+    assert len(linked) == 1
+    row = linked.iloc[0]
+    assert row['Id'] == 'oncomx_11'
+    assert row['Provenance'] == 'oncomx_11|cbd_20'
+    assert row['Pmid'] == '28201998|9042267'
+    assert row['Assay/Test'] == 'Therascreen KRAS RGQ PCR Kit|qRT-PCR'
+    assert row['Molecular type'] == 'somatic mutation|Protein'
+    assert row['Molecular ID'] == 'KRAS'
+
+def test_keeps_different_associations():
+    df = kras_rows()
+    df.loc[1, 'Source'] = 'Blood'
+    assert len(link_biomarkers(df)) == 2